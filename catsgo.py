@@ -5,12 +5,25 @@ import json
 import datetime
 import time
 import sys
+import re
 import logging
 import traceback
+import threading
+import asyncio
+import os
+import fnmatch
+import html.parser
+import urllib.parse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argh
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+import metrics
+import tracing
 import utils
 
 config = utils.load_config("config.json")
@@ -29,31 +42,108 @@ def load_cookies():
         session.cookies.update(pickle.load(f))
 
 
-def login():
-    try:
-        load_cookies()
-    except:
-        logging.error(f"Login {traceback.format_exc()}")
-        pass
-    response = session.get(sp3_url + "/am_i_logged_in")
-    if response.text == "yes":
-        return
-    else:
-        data = {"username": config["username"], "password": config["password"]}
-        response = session.post(sp3_url + "/login?api=v1", data=data)
+# how long (in seconds) a confirmed login is trusted before asking the server again
+login_ttl = int(config.get("login_ttl", 5 * 60))
+login_lock = threading.Lock()
+last_login_check = 0
+cookies_loaded = False
+
+
+def login(force=False):
+    """
+    make sure the session is logged in to sp3
+
+    the login is only re-checked with the server once it was last confirmed more than
+    login_ttl seconds ago, or when force is set (e.g. after an auth failure)
+    """
+    global last_login_check, cookies_loaded
+    with login_lock:
+        if not force and time.time() - last_login_check < login_ttl:
+            return
+        if not cookies_loaded:
+            try:
+                load_cookies()
+            except:
+                logging.error(f"Login {traceback.format_exc()}")
+                pass
+            cookies_loaded = True
         response = session.get(sp3_url + "/am_i_logged_in")
         if response.text != "yes":
-            sys.stderr.write("Error: Couldn't log in\n")
-            sys.exit(1)
-        save_cookies()
+            data = {"username": config["username"], "password": config["password"]}
+            response = session.post(sp3_url + "/login?api=v1", data=data)
+            response = session.get(sp3_url + "/am_i_logged_in")
+            if response.text != "yes":
+                sys.stderr.write("Error: Couldn't log in\n")
+                sys.exit(1)
+            save_cookies()
+        last_login_check = time.time()
+
+
+sp3_request_seconds = metrics.Histogram(
+    "sp3_request_seconds", "SP3 request time", ["method", "endpoint", "status"]
+)
+sp3_relogins = metrics.Counter(
+    "sp3_relogins_total", "SP3 requests retried after logging in again"
+)
+sp3_retries = metrics.Counter(
+    "sp3_retries_total", "SP3 calls retried by try_n_times", ["proc"]
+)
+
+
+def is_auth_failure(response):
+    """
+    sp3 answers requests from an expired session with a 401 or a redirect to the login page
+    """
+    if response.status_code == 401:
+        return True
+    return bool(response.history) and "/login" in response.url
+
+
+def sp3_request(method, url, **kwargs):
+    """
+    make a request to sp3, logging in again and retrying once if the session has expired
+    """
+    with tracing.span(
+        "sp3.request", method=method, endpoint=metrics.normalize_endpoint(url)
+    ) as span:
+        login()
+        response = timed_request(method, url, **kwargs)
+        if is_auth_failure(response):
+            logging.warning(f"sp3 session expired requesting {url}, logging in again")
+            sp3_relogins.inc()
+            # give the connection back to the pool (it isn't if stream=True)
+            response.close()
+            login(force=True)
+            response = timed_request(method, url, **kwargs)
+        span.set("status", response.status_code)
+    return response
+
+
+def timed_request(method, url, **kwargs):
+    start = time.perf_counter()
+    response = session.request(method, url, **kwargs)
+    sp3_request_seconds.observe(
+        time.perf_counter() - start,
+        method=method,
+        endpoint=metrics.normalize_endpoint(url),
+        status=response.status_code,
+    )
+    return response
+
+
+def sp3_get(url, **kwargs):
+    return sp3_request("GET", url, **kwargs)
+
+
+def sp3_post(url, **kwargs):
+    return sp3_request("POST", url, **kwargs)
 
 
 def fetch(fetch_name):
-    login()
     url = sp3_url + f"/fetch_new"
     fetch_kind = "local1"
     fetch_method = config["fetch_method"]
-    response = session.post(
+    response = sp3_post(
         url,
         data={
             "fetch_name": fetch_name,
@@ -69,7 +159,7 @@ def try_n_times(proc, n, sleep_dur):
     attempt = 0
     while True:
         attempt = attempt + 1
-        if attempt > 10:
+        if attempt > n:
             logging.error(f"Error: failed { proc.__name__ } after { n } tries.")
             sys.exit(1)
         try:
@@ -78,21 +168,24 @@ def try_n_times(proc, n, sleep_dur):
             logging.warning(
                 f"Warning: failed { proc.__name__ } attempt { attempt }. Exception: { str(e) }. Retrying after { sleep_dur } seconds."
             )
+            sp3_retries.inc(proc=proc.__name__)
             time.sleep(sleep_dur)
 
 
+def get_fetch_details(fetch_uuid):
+    url = sp3_url + f"/fetch_details/{fetch_uuid}?api=v1"
+    response = sp3_get(url)
+    return json.loads(response.text)
+
+
 def check_fetch(fetch_uuid):
     def check_fetch_inner():
-        login()
-        url = sp3_url + f"/fetch_details/{fetch_uuid}?api=v1"
-        response = session.get(url)
-        return json.loads(response.text)
+        return get_fetch_details(fetch_uuid)
 
     return try_n_times(check_fetch_inner, 10, 60)
 
 
 def run_clockwork(flow_name, fetch_uuid):
-    login()
     url = sp3_url + f"/flow/{ flow_name }/new"
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     run_name = f"sp3c-{ flow_name }-{ timestamp }"
@@ -113,7 +206,7 @@ def run_clockwork(flow_name, fetch_uuid):
         "api": "v1",
     }
 
-    response = session.post(url, data=data)
+    response = sp3_post(url, data=data)
     return json.loads(response.text)
 
 
@@ -133,8 +226,7 @@ def run_covid(flow_name, input_dir):
         "api": "v1",
     }
 
-    login()
-    response = session.post(url, data=data)
+    response = sp3_post(url, data=data)
     return json.loads(response.text)
 
 
@@ -158,8 +250,7 @@ def run_covid_objstore(flow_name, obj_csv):
     ):
         data["varcaller-and---varCaller"] = "viridian"
 
-    login()
-    response = session.post(url, data=data)
+    response = sp3_post(url, data=data)
     return json.loads(response.text)
 
 
@@ -192,8 +283,7 @@ def run_covid_catsup(
     ):
         data["varcaller-and---varCaller"] = "viridian"
 
-    login()
-    response = session.post(url, data=data)
+    response = sp3_post(url, data=data)
     return json.loads(response.text)
 
 
@@ -218,39 +308,39 @@ def run_covid_ena(flow_name, ena_csv, ena_batch, upload_bucket):
     ):
         data["varcaller-and---varCaller"] = "viridian"
 
-    login()
-    response = session.post(url, data=data)
+    response = sp3_post(url, data=data)
     return json.loads(response.text)
 
 
 def get_all_runs(flow_name):
     url = sp3_url + f"/flow/{ flow_name }?api=v2"
-    login()
-    response = session.get(url)
+    response = sp3_get(url)
     return response.json()
 
 
 def get_all_runs2(flow_name):
     url = sp3_url + f"/flow/{ flow_name }?api=v3"
-    login()
-    response = session.get(url)
+    response = sp3_get(url)
     return response.json()
 
 
+def get_run_status(flow_name, run_uuid):
+    url = sp3_url + f"/flow/{ flow_name }/details/{ run_uuid }?api=v1"
+    response = sp3_get(url)
+
+    data = json.loads(response.text)
+    if not data["data"]:
+        return "Error"
+    status = data["data"][0][3]
+    if status == "-":
+        return "Running"
+    else:
+        return status
+
+
 def check_run(flow_name, run_uuid):
     def check_run_inner():
-        login()
-        url = sp3_url + f"/flow/{ flow_name }/details/{ run_uuid }?api=v1"
-        response = session.get(url)
-
-        data = json.loads(response.text)
-        if not data["data"]:
-            return "Error"
-        status = data["data"][0][3]
-        if status == "-":
-            return "Running"
-        else:
-            return status
+        return get_run_status(flow_name, run_uuid)
 
     return try_n_times(check_run_inner, 10, 60)
 
@@ -268,35 +358,224 @@ def check_run_resume(run_uuid):
 
 
 def download_url(run_uuid):
-    login()
     url = f"{ sp3_url }/files/{ run_uuid }/"
     print(url)
 
 
 def download_cmd(run_uuid):
-    login()
     url = f"wget -m -nH --cut-dirs=1 -np -R 'index.*' { sp3_url }/files/{ run_uuid }/"
     return url
 
 
-def download_report(run_uuid, dataset_id, do_print=True):
+class FileIndexParser(html.parser.HTMLParser):
+    """
+    collects the links of an sp3 /files/ directory index page
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.links = list()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+
+
+def list_run_files(run_uuid):
+    """
+    list every file under /files/{run_uuid}/, as paths relative to it
+    """
+    base_url = f"{ sp3_url }/files/{ run_uuid }/"
+    base_path = urllib.parse.urlparse(base_url).path
+    files = list()
+    dirs = [base_url]
+    seen = set(dirs)
+    while dirs:
+        dir_url = dirs.pop()
+        response = sp3_get(dir_url)
+        response.raise_for_status()
+        parser = FileIndexParser()
+        parser.feed(response.text)
+        for href in parser.links:
+            url = urllib.parse.urljoin(dir_url, href.split("?")[0].split("#")[0])
+            path = urllib.parse.urlparse(url).path
+            # skip sorting links, parent dirs and anything outside the run
+            if url in seen or not path.startswith(base_path) or path == base_path:
+                continue
+            seen.add(url)
+            if url.endswith("/"):
+                dirs.append(url)
+            else:
+                files.append(urllib.parse.unquote(path[len(base_path) :]))
+    return sorted(files)
+
+
+def filter_run_files(files, include=None, exclude=None):
+    """
+    keep the files matching any of the comma separated include patterns (all if none)
+    and none of the exclude patterns. Patterns match the path or the file name
+    """
+
+    def matches(f, patterns):
+        return any(
+            fnmatch.fnmatch(f, p) or fnmatch.fnmatch(Path(f).name, p) for p in patterns
+        )
+
+    include = [p for p in (include or "").split(",") if p]
+    exclude = [p for p in (exclude or "").split(",") if p]
+    return [
+        f
+        for f in files
+        if (not include or matches(f, include)) and not matches(f, exclude)
+    ]
+
+
+download_adapter_mounted = False
+
+
+def mount_download_adapter(pool_maxsize):
+    """
+    give the session a connection pool big enough for pool_maxsize parallel downloads
+    """
+    global download_adapter_mounted
+    if download_adapter_mounted:
+        return
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET", "HEAD"],
+            raise_on_status=False,
+        ),
+    )
+    session.mount(sp3_url, adapter)
+    download_adapter_mounted = True
+
+
+def download_run_file(run_uuid, file_path, outdir, known, chunk_size=1024 * 1024):
+    """
+    download one file of a run to outdir, resuming a partial download if there is one
+
+    known is the manifest entry (size, etag) from the last time the file was downloaded.
+    Without one, a file already in outdir (e.g. from download_cmd) is kept if its size
+    matches. Returns the new manifest entry and whether anything was downloaded
+    """
+    url = f"{ sp3_url }/files/{ run_uuid }/{ urllib.parse.quote(file_path) }"
+    head = sp3_request("HEAD", url, allow_redirects=True)
+    head.raise_for_status()
+    size = int(head.headers["Content-Length"]) if "Content-Length" in head.headers else None
+    etag = head.headers.get("ETag")
+    entry = {"size": size, "etag": etag}
+
+    dest = Path(outdir) / file_path
+    if dest.exists() and size is not None and dest.stat().st_size == size:
+        if not known or (known.get("size") == size and known.get("etag") == etag):
+            return entry, False
+
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part = dest.with_name(dest.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    headers = dict()
+    if offset and (size is None or offset < size):
+        headers["Range"] = f"bytes={offset}-"
+        if etag:
+            # only resume if the file hasn't changed since the partial download
+            headers["If-Range"] = etag
+    with sp3_get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(part, mode) as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+    if size is not None and part.stat().st_size != size:
+        raise Exception(
+            f"{file_path}: got {part.stat().st_size} bytes, expected {size}"
+        )
+    os.replace(part, dest)
+    return entry, True
+
+
+def download_run(run_uuid, outdir=None, workers=8, include=None, exclude=None):
+    """
+    download the output files of a run in parallel (instead of download_cmd's wget)
+
+    files already downloaded with the same size and ETag (or already in outdir with
+    the right size) are skipped and partial downloads are resumed. include/exclude are comma separated patterns, e.g.
+    --include '*_report.json,*.vcf'
+    """
+    login()
+    workers = int(workers)
+    mount_download_adapter(workers)
+    outdir = Path(outdir or run_uuid)
+    outdir.mkdir(parents=True, exist_ok=True)
+    manifest_file = outdir / ".catsgo_manifest.json"
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else dict()
+
+    files = filter_run_files(list_run_files(run_uuid), include, exclude)
+    sys.stderr.write(f"{ len(files) } files to check\n")
+
+    def save_manifest():
+        tmp = manifest_file.with_name(manifest_file.name + ".tmp")
+        tmp.write_text(json.dumps(manifest, indent=4))
+        os.replace(tmp, manifest_file)
+
+    downloaded, skipped, failed = 0, 0, 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    download_run_file, run_uuid, f, outdir, manifest.get(f)
+                ): f
+                for f in files
+            }
+            for future in as_completed(futures):
+                f = futures[future]
+                try:
+                    entry, was_downloaded = future.result()
+                except Exception as e:
+                    failed += 1
+                    logging.error(f"failed to download {f}: {e}")
+                    continue
+                manifest[f] = entry
+                if was_downloaded:
+                    downloaded += 1
+                    sys.stderr.write(f"downloaded {f}\n")
+                else:
+                    skipped += 1
+                if (downloaded + skipped) % 100 == 0:
+                    save_manifest()
+    finally:
+        # also when interrupted, so that the files done so far are skipped next time
+        save_manifest()
+
+    sys.stderr.write(
+        f"{downloaded} downloaded, {skipped} already up to date, {failed} failed\n"
+    )
+    if failed:
+        sys.exit(1)
+
+
+def download_report(run_uuid, dataset_id, do_print=True, retries=10):
     def download_report_inner():
-        login()
         url = f"{ sp3_url }/flow/{ run_uuid }/{ dataset_id }/report?api=v1"
-        response = session.get(url)
+        response = sp3_get(url)
         if do_print:
             return json.dumps(response.json(), indent=4)
         else:
             return response.json()
 
-    return try_n_times(download_report_inner, 10, 60)
+    return try_n_times(download_report_inner, retries, 60)
 
 
 def run_info(flow_name, run_uuid, do_print=True):
     def run_info_inner():
-        login()
         url = f"{ sp3_url }/flow/{ flow_name }/details/{ run_uuid }?api=v1"
-        response = session.get(url)
+        response = sp3_get(url)
         if do_print:
             return json.dumps(response.json(), indent=4)
         else:
@@ -305,26 +584,56 @@ def run_info(flow_name, run_uuid, do_print=True):
     return try_n_times(run_info_inner, 10, 60)
 
 
-def download_reports(flow_name, run_uuid):
+def download_reports(flow_name, run_uuid, workers=8, retries=10):
+    """
+    download the reports of every sample in a run and print them as one json object
+
+    reports are downloaded by a pool of workers and written out as soon as each one
+    finishes, so the whole run is never held in memory. Samples whose report couldn't
+    be downloaded are left out (the output is still valid json) and make it exit with 1
+    """
     login()
     info = run_info(flow_name, run_uuid, do_print=False)
     sample_names = list(info["trace_nice"].keys())
     sample_names.remove("unknown")
     sys.stderr.write(f"downloading { len(sample_names) } reports\n")
-    out = dict()
-    for i, sample_name in enumerate(sample_names):
-        sys.stderr.write(f"Downloading report {i}. { run_uuid }/{ sample_name }\n")
-        out[sample_name] = download_report(run_uuid, sample_name, do_print=False)
-        sys.stderr.write(
-            f"Downloaded report {i}. { run_uuid }/{ sample_name } len: { len(out[sample_name]) }\n"
-        )
-    print(json.dumps(out, indent=4))
+
+    def download_one(sample_name):
+        return download_report(run_uuid, sample_name, do_print=False, retries=retries)
+
+    sys.stdout.write("{")
+    written, failed = 0, list()
+    with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        futures = {
+            executor.submit(download_one, sample_name): sample_name
+            for sample_name in sample_names
+        }
+        for future in as_completed(futures):
+            sample_name = futures[future]
+            try:
+                report = future.result()
+            except (Exception, SystemExit) as e:
+                # try_n_times exits when it runs out of retries
+                sys.stderr.write(f"Failed to download { run_uuid }/{ sample_name }: {e!r}\n")
+                failed.append(sample_name)
+                continue
+            sys.stderr.write(
+                f"Downloaded report {written}. { run_uuid }/{ sample_name } len: { len(report) }\n"
+            )
+            # indent the report so the output matches json.dumps(..., indent=4) of the whole dict
+            report_json = json.dumps(report, indent=4).replace("\n", "\n    ")
+            sys.stdout.write(f"{',' if written else ''}\n    {json.dumps(sample_name)}: {report_json}")
+            sys.stdout.flush()
+            written += 1
+    sys.stdout.write("\n}\n" if written else "}\n")
+    if failed:
+        sys.stderr.write(f"{ len(failed) } reports couldn't be downloaded: {', '.join(failed)}\n")
+        sys.exit(1)
 
 
 def download_nextflow_task_data(flow_name, run_uuid, do_print=True):
-    login()
     url = f"{ sp3_url }/flow/{ flow_name }/report/{ run_uuid }?api=v1"
-    response = session.get(url)
+    response = sp3_get(url)
     if do_print:
         return response.text
     else:
@@ -332,9 +641,8 @@ def download_nextflow_task_data(flow_name, run_uuid, do_print=True):
 
 
 def download_nextflow_task_data_csv(flow_name, run_uuid, do_print=True):
-    login()
     url = f"{ sp3_url }/flow/{ flow_name }/report/{ run_uuid }?api=v1"
-    response = session.get(url)
+    response = sp3_get(url)
     import pandas, io
 
     trace = json.dumps(json.loads(response.text)["trace"])
@@ -385,6 +693,167 @@ def go(fetch_name):
     print(f"{cmd} | bash")
 
 
+uuid_re = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE
+)
+
+
+def emit_event(event, **fields):
+    """
+    print a tracker event as one json line
+    """
+    sys.stdout.write(json.dumps({"event": event, "time": int(time.time()), **fields}) + "\n")
+    sys.stdout.flush()
+
+
+class RunTracker:
+    """
+    follows many fetches/runs from one asyncio event loop
+
+    the blocking sp3 calls run on a small thread pool. Each target is polled after
+    initial_interval seconds, then backoff times longer each time its status hasn't
+    changed, up to max_interval
+    """
+
+    def __init__(
+        self,
+        flow_name,
+        workers=8,
+        initial_interval=30,
+        max_interval=300,
+        backoff=1.5,
+        max_failures=10,
+    ):
+        self.flow_name = flow_name
+        self.executor = ThreadPoolExecutor(max_workers=int(workers))
+        self.initial_interval = float(initial_interval)
+        self.max_interval = float(max_interval)
+        self.backoff = float(backoff)
+        self.max_failures = int(max_failures)
+
+    async def call(self, proc, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, proc, *args)
+
+    async def poll(self, proc, args, is_done, name):
+        """
+        call proc(*args) until is_done(result), backing off between polls
+
+        errors are retried (with the same backoff) up to max_failures times in a row
+        """
+        interval = self.initial_interval
+        failures = 0
+        last_result = None
+        while True:
+            try:
+                result = await self.call(proc, *args)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures >= self.max_failures:
+                    raise
+                logging.warning(
+                    f"failed {proc.__name__} for {name} ({failures}/{self.max_failures}): {e}"
+                )
+                result = last_result
+            if result is not None and is_done(result):
+                return result
+            if result != last_result:
+                interval = self.initial_interval
+            last_result = result
+            await asyncio.sleep(interval)
+            interval = min(self.max_interval, interval * self.backoff)
+
+    async def track_fetch(self, fetch_name):
+        response = await self.call(fetch, fetch_name)
+        fetch_uuid = response["guid"]
+        emit_event("fetch_started", fetch_name=fetch_name, fetch_uuid=fetch_uuid)
+
+        response = await self.poll(
+            get_fetch_details,
+            (fetch_uuid,),
+            lambda r: r["status"] in ["failed", "success"],
+            fetch_name,
+        )
+        if response["status"] == "failed":
+            emit_event("fetch_failed", fetch_name=fetch_name, fetch_uuid=fetch_uuid)
+            return
+        if response["total"] == 0:
+            emit_event("fetch_empty", fetch_name=fetch_name, fetch_uuid=fetch_uuid)
+            return
+        emit_event("fetch_done", fetch_name=fetch_name, fetch_uuid=fetch_uuid)
+
+        response = await self.call(run_clockwork, self.flow_name, fetch_uuid)
+        run_uuid = response["run_uuid"]
+        emit_event("run_started", fetch_name=fetch_name, run_uuid=run_uuid)
+        await self.track_run(run_uuid)
+
+    async def track_run(self, run_uuid):
+        status = await self.poll(
+            get_run_status,
+            (self.flow_name, run_uuid),
+            lambda r: r in ["OK", "ERR", "Error"],
+            run_uuid,
+        )
+        if status == "OK":
+            emit_event(
+                "run_done",
+                run_uuid=run_uuid,
+                status=status,
+                download_cmd=f"{download_cmd(run_uuid)} | bash",
+            )
+        else:
+            emit_event("run_failed", run_uuid=run_uuid, status=status)
+
+    async def track_one(self, target):
+        try:
+            if uuid_re.match(target):
+                await self.track_run(target)
+            else:
+                await self.track_fetch(target)
+        except Exception as e:
+            logging.error(f"Error tracking {target}: {traceback.format_exc()}")
+            emit_event("track_error", target=target, error=str(e))
+
+    async def track_all(self, targets):
+        await asyncio.gather(*[self.track_one(target) for target in targets])
+
+    def track(self, targets):
+        # asyncio.run makes a new event loop and closes it when it's done
+        try:
+            asyncio.run(self.track_all(targets))
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+def track(
+    *targets,
+    flow_name=None,
+    workers=8,
+    initial_interval=30,
+    max_interval=300,
+    backoff=1.5,
+    max_failures=10,
+):
+    """
+    fetch and run (fetch paths) or follow (run uuids) many runs at once
+
+    prints one json line per event (fetch_started, fetch_done, run_started, run_done
+    with the download command, *_failed) as each fetch/run progresses
+    """
+    if flow_name is None:
+        flow_name = config["clockwork_flow_name"]
+    login()
+    RunTracker(
+        flow_name,
+        workers=workers,
+        initial_interval=initial_interval,
+        max_interval=max_interval,
+        backoff=backoff,
+        max_failures=max_failures,
+    ).track(targets)
+
+
 if __name__ == "__main__":
     parser = argh.ArghParser()
     parser.add_commands(
@@ -396,10 +865,12 @@ if __name__ == "__main__":
             check_run,
             download_reports,
             download_cmd,
+            download_run,
             download_url,
             run_info,
             run_clockwork,
             go,
+            track,
             download_report,
             download_nextflow_task_data,
             download_nextflow_task_data_csv,
@@ -3,9 +3,19 @@ import requests
 import json
 import sys
 import configparser
+import fcntl
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from collections import KeysView
 
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+import metrics
+import tracing
 import utils
 
 
@@ -19,13 +29,148 @@ logging.basicConfig(
 
 logging.getLogger().setLevel(logging.INFO)
 
-def get_apex_token():
+
+class ApexRetry(Retry):
+    """
+    Retry that only retries a PUT when apex can't have applied it: connection errors,
+    429 and 503. run_watcher's PUTs add analyses, so a PUT that got a 500 or a read
+    timeout after apex had applied it would add the analysis twice
+    """
+
+    put_retry_statuses = (429, 503)
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == "PUT" and status_code not in self.put_retry_statuses:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if method == "PUT" and isinstance(error, (ReadTimeoutError, ProtocolError)):
+            # the request was sent, so it may have been applied
+            raise error
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class ApexClient:
+    """
+    shared http client for the APEX/ORDS api
+
+    connections to the ORDS host are kept alive and pooled, every request has a
+    timeout, 429 and 5xx responses to GET (and connection errors, 429 and 503 to PUT,
+    see ApexRetry) are retried with backoff and a rejected (401) bearer token is
+    replaced with a new one and the request sent again
+    """
+
+    def __init__(self, host, timeout=(10, 120), retries=5, backoff_factor=1, pool_maxsize=16):
+        self.host = host
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=pool_maxsize,
+            max_retries=ApexRetry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "PUT"],
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.rejected_tokens = set()
+
+    def get_token(self, apex_token=None):
+        with self.lock:
+            if apex_token and apex_token not in self.rejected_tokens:
+                return apex_token
+        return get_apex_token()
+
+    def refresh_token(self, rejected_token):
+        with self.lock:
+            self.rejected_tokens.add(rejected_token)
+        return get_apex_token(rejected_token=rejected_token)
+
+    def request(self, method, url, apex_token=None, headers=None, **kwargs):
+        """
+        url can be a full url or a path on the ORDS host. apex_token is used unless it has
+        already been rejected, in which case the client's own token is used
+        """
+        if not url.startswith("http"):
+            url = self.host + url
+        kwargs.setdefault("timeout", self.timeout)
+        with tracing.span(
+            "apex.request", method=method, endpoint=metrics.normalize_endpoint(url)
+        ) as span:
+            token = self.get_token(apex_token)
+            response = self.send(method, url, token, headers, **kwargs)
+            if response.status_code == 401:
+                logging.warning(f"apex token rejected by {method} {url}, getting a new one")
+                apex_token_refreshes.inc()
+                token = self.refresh_token(token)
+                response = self.send(method, url, token, headers, **kwargs)
+            span.set("status", response.status_code)
+        return response
+
+    def send(self, method, url, token, headers, **kwargs):
+        endpoint = metrics.normalize_endpoint(url)
+        start = time.perf_counter()
+        response = self.session.request(
+            method,
+            url,
+            headers={**(headers or dict()), "Authorization": f"Bearer {token}"},
+            **kwargs,
+        )
+        apex_request_seconds.observe(
+            time.perf_counter() - start,
+            method=method,
+            endpoint=endpoint,
+            status=response.status_code,
+        )
+        retries = getattr(response.raw, "retries", None)
+        if retries and retries.history:
+            apex_retries.inc(len(retries.history), method=method, endpoint=endpoint)
+        return response
+
+    def get(self, url, apex_token=None, **kwargs):
+        return self.request("GET", url, apex_token, **kwargs)
+
+    def put(self, url, apex_token=None, **kwargs):
+        return self.request("PUT", url, apex_token, **kwargs)
+
+    def post(self, url, apex_token=None, **kwargs):
+        return self.request("POST", url, apex_token, **kwargs)
+
+
+apex_request_seconds = metrics.Histogram(
+    "apex_request_seconds", "APEX/ORDS request time", ["method", "endpoint", "status"]
+)
+apex_retries = metrics.Counter(
+    "apex_retries_total", "APEX/ORDS requests retried after an error response", ["method", "endpoint"]
+)
+apex_token_refreshes = metrics.Counter(
+    "apex_token_refreshes_total", "requests retried with a new token after a 401"
+)
+apex_token_requests = metrics.Counter(
+    "apex_token_requests_total", "new tokens requested from IDCS"
+)
+
+apex = ApexClient(
+    config["host"],
+    timeout=(config.get("connect_timeout", 10), config.get("read_timeout", 120)),
+)
+
+
+def request_apex_token():
+    """
+    get a new token from IDCS. Returns (token, expires_in)
+    """
     with open("secrets.json") as f:
         c = json.load(f)
         client_id = c.get("client_id")
         client_secret = c.get("client_secret")
 
-    access_token_response = requests.post(
+    access_token_response = apex.session.post(
         config["idcs"],
         data={
             "grant_type": "client_credentials",
@@ -33,47 +178,164 @@ def get_apex_token():
         },
         allow_redirects=False,
         auth=(client_id, client_secret),
+        timeout=apex.timeout,
     )
-    access_token = access_token_response.json().get("access_token")
-    return access_token
+    j = access_token_response.json()
+    return j.get("access_token"), int(j.get("expires_in", 3600))
+
+
+class TokenProvider:
+    """
+    caches the APEX bearer token until refresh_margin seconds before it expires
+
+    the token is also kept in cache_file (only readable by this user, locked while
+    it's being read or refreshed) so that all the watchers on a host share one token
+    instead of each getting their own from IDCS
+    """
+
+    def __init__(self, cache_file="apex_token.json", refresh_margin=5 * 60):
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0
+
+    def is_fresh(self, token, expires_at, rejected_token):
+        return (
+            token
+            and token != rejected_token
+            and time.time() < expires_at - self.refresh_margin
+        )
+
+    def get_token(self, rejected_token=None):
+        """
+        get a token that's valid for at least refresh_margin more seconds
+
+        rejected_token is a token the server has refused, which won't be returned again
+        """
+        with self.lock:
+            if self.is_fresh(self.token, self.expires_at, rejected_token):
+                return self.token
+
+            fd = os.open(self.cache_file, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "r+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    cached = json.loads(f.read() or "{}")
+                except ValueError:
+                    cached = dict()
+                if self.is_fresh(cached.get("token"), cached.get("expires_at", 0), rejected_token):
+                    self.token, self.expires_at = cached["token"], cached["expires_at"]
+                    return self.token
+
+                logging.info("Acquiring new apex token")
+                apex_token_requests.inc()
+                token, expires_in = request_apex_token()
+                self.token, self.expires_at = token, time.time() + expires_in
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"token": self.token, "expires_at": self.expires_at}))
+                return self.token
+
+
+token_provider = TokenProvider(
+    config.get("token_cache_file", "apex_token.json"),
+    config.get("token_refresh_margin", 5 * 60),
+)
+
+
+def get_apex_token(rejected_token=None):
+    return token_provider.get_token(rejected_token)
+
 
 def update_sample(sample_id, data, apex_token, config=config):
     url = f"{config['host']}/samples/{sample_id}"
-    headers = {
-        "Authorization": f"Bearer {apex_token}",
-        "Content-type": "application/json",
-    }
-    response = requests.put(url, headers=headers, data=data)
+    headers = {"Content-type": "application/json"}
+    response = apex.put(url, apex_token, headers=headers, data=data)
     return response
 
 
-def get_batches(apex_token, config=config):
-    url = f"{config['host']}/batches"
-    method = "GET"
-    headers = {"Authorization": f"Bearer {apex_token}"}
-    response = requests.get(url, headers=headers)
+def get_next_link(page):
+    """
+    the url of the next page of an ORDS collection, or None if this is the last one
+    """
+    if not isinstance(page, dict) or not page.get("hasMore"):
+        return None
+    for link in page.get("links", list()):
+        if link.get("rel") == "next":
+            return link.get("href")
+    return None
+
+
+def iter_pages(url, apex_token, params=None, prefetch=False):
+    """
+    yield the pages of an ORDS collection, following the "next" links for as long as hasMore is set
+
+    with prefetch, the next page is requested in the background while the caller
+    works on the current one
+    """
+
+    def get_page(page_url, page_params):
+        response = apex.get(page_url, apex_token, params=page_params)
+        try:
+            return response.json()
+        except:
+            logging.error(f"unexpected response from GET {page_url}: {response.text}")
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
     try:
-        return response.json()
-    except:
-        logging.error(f"unexpected response from GET {url}: {response.text}")
-        return []
+        page = get_page(url, params)
+        while page is not None:
+            # the next link already carries the query string (offset, limit, q)
+            next_url = get_next_link(page)
+            next_page = None
+            if executor and next_url:
+                next_page = executor.submit(tracing.propagate(get_page), next_url, None)
+            yield page
+            if not next_url:
+                break
+            page = next_page.result() if next_page else get_page(next_url, None)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+
+def iter_items(url, apex_token, q=None, prefetch=False):
+    """
+    yield the items of every page of an ORDS collection
+
+    q is an ORDS filter object, e.g. {"organisationname": "x"}, applied by the server
+    """
+    params = {"q": json.dumps(q)} if q else None
+    for page in iter_pages(url, apex_token, params=params, prefetch=prefetch):
+        for item in page.get("items", list()):
+            yield item
+
+
+def iter_batches(apex_token, q=None, prefetch=True, config=config):
+    return iter_items(f"{config['host']}/batches", apex_token, q=q, prefetch=prefetch)
+
+
+def iter_batches_by_status(status, apex_token, prefetch=True, config=config):
+    return iter_items(
+        f"{config['host']}/batches_by_status/{status}", apex_token, prefetch=prefetch
+    )
+
+
+def iter_organisations(apex_token, q=None, prefetch=True, config=config):
+    return iter_items(f"{config['host']}/organisations", apex_token, q=q, prefetch=prefetch)
+
+
+def get_batches(apex_token, config=config):
+    return {"items": list(iter_batches(apex_token, config=config))}
 
 def get_organisations(apex_token, config=config):
-    url = f"{config['host']}/organisations"
-    method = "GET"
-    headers = {"Authorization": f"Bearer {apex_token}"}
-    response = requests.get(url, headers=headers)
-    try:
-        return response.json()
-    except:
-        logging.error(f"unexpected response from GET {url}: {response.text}")
-        return []
+    return {"items": list(iter_organisations(apex_token, config=config))}
 
 def get_batch_samples(batch_id, apex_token, config=config):
     url = f"{config['host']}/batches/{batch_id}"
-    method = "GET"
-    headers = {"Authorization": f"Bearer {apex_token}"}
-    response = requests.get(url, headers=headers)
+    response = apex.get(url, apex_token)
     try:
         return response.json()
     except:
@@ -82,9 +344,7 @@ def get_batch_samples(batch_id, apex_token, config=config):
 
 def get_sample(sample_id, apex_token, config=config):
     url = f"{config['host']}/samples/{sample_id}"
-    method = "GET"
-    headers = {"Authorization": f"Bearer {apex_token}"}
-    response = requests.get(url, headers=headers)
+    response = apex.get(url, apex_token)
     #   assert print(response) # is 200
     # print(response)
     # print(response.text)
@@ -95,8 +355,8 @@ def get_sample(sample_id, apex_token, config=config):
         return {}
 
 
-def filter_sample(sample_id, pipeline_version, config=config):
-    sample = get_sample(sample_id, config)
+def filter_sample(sample_id, pipeline_version, apex_token, config=config):
+    sample = get_sample(sample_id, apex_token, config=config)
     if "analysis" in sample:
         if sample["analysis"]["pipelineVersion"] == pipeline_version:
             return None
@@ -106,65 +366,106 @@ def filter_sample(sample_id, pipeline_version, config=config):
         return sample_id
 
 
-def run_samples(pipeline_version, query=None, config=config):
-    for sample in all_samples(query=query, config=config):
+def run_samples(pipeline_version, apex_token, query=None, batch_ids=None, config=config):
+    for sample in all_samples(apex_token, query=query, batch_ids=batch_ids, config=config):
         print(sample)
-        s = filter_sample(sample["id"], pipeline_version)
+        s = filter_sample(sample["id"], pipeline_version, apex_token, config=config)
         if s:
             yield s
 
 
-def all_samples(query=None, config=config):
-    j = []
-    for batch in get_batches(config)["items"]:
-        batch_id = batch["sample_batch_id"]
-        if batch_id != 266102641558548155500056123446365829360:
+def all_samples(apex_token, query=None, batch_ids=None, q=None, config=config):
+    """
+    yield the samples of every batch (or only of batch_ids), one batch at a time
+
+    q is passed to the server to filter the batches, query filters the samples (see iter_samples)
+    """
+    for batch in iter_batches(apex_token, q=q, config=config):
+        batch_id = batch["sampleBatchId"]
+        if batch_ids and batch_id not in batch_ids:
             continue
         print(batch_id)
-        j += get_samples(batch_id, query=query, config=config)["samples"]
-    return j
+        for sample in iter_samples(batch_id, apex_token, query=query, config=config):
+            yield sample
 
 
 def submit_batch(batch, apex_token, config=config):
     url = f"{config['host']}/batches"
-    headers = {
-        "Authorization": f"Bearer {apex_token}",
-        "Content-type": "application/json",
-    }
-    response = requests.post(url, headers=headers, json=batch)
+    response = apex.post(url, apex_token, json=batch)
     return response
 
 
-def get_batch_by_name(batch_name, apex_token, config=config):
-    batches = get_batches(apex_token)
-    if isinstance(batches.keys(), KeysView):
-        found = False
-        for batch in batches['items']:
-            if batch_name == batch['fileName']:
-                found = True
-                batch_dict = {
-                    'id' : batch['sampleBatchId'],
-                    'name' : batch['fileName']
-                }
-                batch_samples = get_batch_samples(batch['sampleBatchId'], apex_token)
-                sample_dict = {}
-                for batch_sample in batch_samples['samples']:
-                    sample_info = get_sample(batch_sample['id'], apex_token)
-                    sample_dict[batch_sample['name']] = sample_info[0]
-                    sample_dict[batch_sample['name']]['batchFileName'] = batch['fileName']
-                batch_dict['samples'] = sample_dict
-                return batch_dict
-        if not found:
-            return {}
-    else:
-        logging.error(f"API response not as expected, quiting. Output - {batches}")
+# fileName -> sampleBatchId of the batches seen in /batches. Batches aren't renamed,
+# so the listing only needs fetching again when a name isn't found, and then at most
+# once every batch_index_min_refresh_interval seconds
+batch_ids_by_name = dict()
+batch_ids_lock = threading.Lock()
+batch_index_refresh_lock = threading.Lock()
+batch_index_refreshed_at = 0
+batch_index_min_refresh_interval = config.get("batch_index_min_refresh_interval", 60)
+
+
+def refresh_batch_index(apex_token):
+    """
+    fetch /batches again, unless it was fetched (or tried) in the last
+    batch_index_min_refresh_interval seconds. Concurrent misses wait for one refresh
+    """
+    global batch_index_refreshed_at
+    with batch_index_refresh_lock:
+        if time.time() - batch_index_refreshed_at < batch_index_min_refresh_interval:
+            return True
+        batch_index_refreshed_at = time.time()
+        try:
+            for batch in iter_batches(apex_token):
+                with batch_ids_lock:
+                    batch_ids_by_name[batch["fileName"]] = batch["sampleBatchId"]
+        except (KeyError, AttributeError) as e:
+            logging.error(f"API response not as expected, quiting. Error - {e}")
+            return False
+    return True
+
+
+def get_batch_id_by_name(batch_name, apex_token):
+    with batch_ids_lock:
+        batch_id = batch_ids_by_name.get(batch_name)
+    if batch_id is None:
+        if not refresh_batch_index(apex_token):
+            return None
+        with batch_ids_lock:
+            batch_id = batch_ids_by_name.get(batch_name)
+    return batch_id
+
+
+def get_batch_by_name(batch_name, apex_token, config=config, workers=8):
+    batch_id = get_batch_id_by_name(batch_name, apex_token)
+    if batch_id is None:
         return {}
 
+    batch_dict = {
+        'id' : batch_id,
+        'name' : batch_name
+    }
+    batch_samples = get_batch_samples(batch_id, apex_token)
+    # fetch the sample records concurrently rather than one round trip after another
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sample_infos = list(
+            executor.map(
+                tracing.propagate(
+                    lambda batch_sample: get_sample(batch_sample['id'], apex_token)
+                ),
+                batch_samples['samples'],
+            )
+        )
+    sample_dict = {}
+    for batch_sample, sample_info in zip(batch_samples['samples'], sample_infos):
+        sample_dict[batch_sample['name']] = sample_info[0]
+        sample_dict[batch_sample['name']]['batchFileName'] = batch_name
+    batch_dict['samples'] = sample_dict
+    return batch_dict
+
 def get_analysis(sample_id, apex_token, config=config):
     url = f"{config['host']}/samples/{sample_id}"
-    method = "GET"
-    headers = {"Authorization": f"Bearer {apex_token}"}
-    response = requests.get(url, headers=headers)
+    response = apex.get(url, apex_token)
     #   assert print(response) # is 200
     # print(f"{response}, {response.text}")
     safe_response = response.text.replace(
@@ -182,57 +483,157 @@ def get_analysis(sample_id, apex_token, config=config):
     return analyses
 
 
+def filter_samples(samples, query, negate_query=False):
+    """
+    yield the samples that have an analysis with key k equal to v, where query is (k, v)
+    (or the samples that don't, with negate_query)
+    """
+    k, v = query
+    for sample in samples:
+        match = not negate_query
+        if "analysis" not in sample:
+            continue
+        for analysis in sample["analysis"]:
+            if k in analysis:
+                if analysis[k] == v:
+                    match = negate_query
+        if match:
+            yield sample
+
+
+def iter_samples(batch_id, apex_token, query=None, negate_query=False, config=config):
+    """
+    yield the samples of a batch, filtered by query if given (see filter_samples)
+    """
+    url = f"{config['host']}/batches/{batch_id}"
+    samples = (
+        sample
+        for page in iter_pages(url, apex_token)
+        for sample in page.get("samples", list())
+    )
+    if query:
+        samples = filter_samples(samples, query, negate_query)
+    for sample in samples:
+        yield sample
+
+
 def get_samples(batch_id, apex_token, query=None, negate_query=False, config=config):
+    if query:
+        return list(
+            iter_samples(
+                batch_id, apex_token, query=query, negate_query=negate_query, config=config
+            )
+        )
+
     url = f"{config['host']}/batches/{batch_id}"
-    method = "GET"
-    headers = {"Authorization": f"Bearer {apex_token}"}
-    response = requests.get(url, headers=headers)
-    j = None
+    response = apex.get(url, apex_token)
     try:
-        j = response.json()
+        return response.json()
     except:
         logging.error("empty response from host")
         return []
 
-    if query:
-        samples = []
-        k, v = query
-        for sample in j["samples"]:
-            match = not negate_query
-            if "analysis" not in sample:
-                continue
-            for analysis in sample["analysis"]:
-                if k in analysis:
-                    if analysis[k] == v:
-                        match = negate_query
-            if match:
-                samples.append(sample)
-        return samples
+class OrganisationCache:
+    """
+    input bucket -> output bucket and organisation -> input bucket maps from /organisations
+
+    maps younger than ttl seconds are used as they are. Older ones are still used (for
+    up to max_stale more seconds) while a background thread refreshes them, so a slow
+    ORDS delays the refresh rather than the caller. A bucket or organisation that isn't
+    in the maps triggers a refresh. Refreshes are attempted at most once every
+    min_refresh_interval seconds, whether or not the last one worked, so an ORDS outage
+    doesn't make every lookup wait for another one
+    """
+
+    def __init__(self, ttl=10 * 60, max_stale=24 * 60 * 60, min_refresh_interval=60):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.min_refresh_interval = min_refresh_interval
+        self.lock = threading.Lock()
+        self.output_buckets = dict()
+        self.input_buckets = dict()
+        self.loaded_at = 0
+        self.attempted_at = 0
+        self.refreshing = False
+
+    def can_refresh(self):
+        return time.time() - self.attempted_at > self.min_refresh_interval
+
+    def refresh(self, apex_token=None):
+        self.attempted_at = time.time()
+        output_buckets = dict()
+        input_buckets = dict()
+        try:
+            for organisation in iter_organisations(apex_token):
+                output_buckets[organisation["inputBucketName"]] = organisation["outputBucketName"]
+                input_buckets[organisation["organisationName"]] = organisation["inputBucketName"]
+        except Exception as e:
+            logging.error(f"couldn't get organisations: {e}")
+            return False
+        if not output_buckets:
+            logging.error("couldn't get organisations: none returned")
+            return False
+        with self.lock:
+            self.output_buckets = output_buckets
+            self.input_buckets = input_buckets
+            self.loaded_at = time.time()
+        return True
+
+    def refresh_in_background(self, apex_token=None):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh(apex_token)
+            finally:
+                with self.lock:
+                    self.refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_maps(self, apex_token=None):
+        age = time.time() - self.loaded_at
+        if age >= self.ttl:
+            if self.loaded_at and age < self.ttl + self.max_stale:
+                if self.can_refresh():
+                    self.refresh_in_background(apex_token)
+            elif self.can_refresh() and not self.refresh(apex_token) and self.loaded_at:
+                logging.warning(f"using organisations from {int(age)}s ago")
+        return self.output_buckets, self.input_buckets
+
+    def lookup(self, key, which, apex_token=None):
+        maps = self.get_maps(apex_token)
+        if key not in maps[which] and self.can_refresh():
+            self.refresh(apex_token)
+            maps = (self.output_buckets, self.input_buckets)
+        return maps[which].get(key)
+
+    def get_output_bucket(self, input_bucket, apex_token=None):
+        return self.lookup(input_bucket, 0, apex_token)
+
+    def get_input_bucket(self, organisation_name, apex_token=None):
+        return self.lookup(organisation_name, 1, apex_token)
+
+
+organisation_cache = OrganisationCache(
+    ttl=config.get("organisations_ttl", 10 * 60),
+    max_stale=config.get("organisations_max_stale", 24 * 60 * 60),
+)
 
-    else:
-        return j
 
 def get_output_bucket_from_input(input_bucket, apex_token, config=config):
-    organisations = get_organisations(apex_token)
-    if isinstance(organisations.keys(), KeysView):
-        found = False
-        for organisation in organisations['items']:
-            if input_bucket == organisation['inputBucketName']:
-                found = True
-                return organisation['outputBucketName']
-        if not found:
-            return None
-    else:
-        logging.error(f"API response not as expected, quiting. Output - {organisations}")
-        return None
+    return organisation_cache.get_output_bucket(input_bucket, apex_token)
+
+
+def get_input_bucket_from_organisation(organisation_name, apex_token=None):
+    return organisation_cache.get_input_bucket(organisation_name, apex_token)
 
 def post_metadata_to_apex(data, apex_token):
     # logging.info(apex_token)
-    batch_response = requests.post(
-        f"{config['host']}/batches",
-        headers={"Authorization": f"Bearer {apex_token}"},
-        json=data,
-    )
+    batch_response = apex.post(f"{config['host']}/batches", apex_token, json=data)
 
     try:
         apex_batch = batch_response.json()
@@ -248,10 +649,7 @@ def post_metadata_to_apex(data, apex_token):
         return None, None
     print(batch_id)
 
-    samples_response = requests.get(
-        f"{config['host']}/batches/{batch_id}",
-        headers={"Authorization": f"Bearer {apex_token}"},
-    )
+    samples_response = apex.get(f"{config['host']}/batches/{batch_id}", apex_token)
     apex_samples = samples_response.json()
 
     return apex_batch, apex_samples
@@ -11,7 +11,9 @@ import json
 import logging
 import os
 import time
+import heapq
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 import traceback
 import argh
@@ -20,7 +22,17 @@ import pymongo
 import requests
 import catsgo
 import db
+import metrics
+import mongo_store
+import tracing
 import sentry_sdk
+from submission_scheduler import SubmissionScheduler
+from submission_tracker import SubmissionFailed, SubmissionTracker
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 config = utils.load_config("config.json")
 
@@ -33,12 +45,41 @@ sentry_sdk.init(
     traces_sample_rate=config['sentry_traces_sample_rate']
 )
 
-myclient = pymongo.MongoClient("mongodb://localhost:27017/")
+myclient = pymongo.MongoClient(
+    "mongodb://localhost:27017/", event_listeners=metrics.mongo_listeners
+)
 mydb = myclient["dir_watcher"]
 dirlist = mydb["dirlist"]
+processed_dirs = mydb["processed_dirs"]
 metadata = mydb["metadata"]
 ignore_list = mydb["ignore_list"]
 
+mongo_store.ensure_indexes(processed_dirs, ["watch_dir"])
+
+# seconds before a failed upload is retried, doubling with every attempt
+submission_tracker = SubmissionTracker(
+    mydb,
+    backoff=int(config.get("submission_retry_backoff", 300)),
+    max_backoff=int(config.get("submission_retry_max_backoff", 6 * 60 * 60)),
+)
+
+poll_seconds = metrics.Histogram(
+    "dir_watcher_poll_seconds", "time taken to poll a bucket", ["bucket"]
+)
+dirs_scanned = metrics.Gauge(
+    "dir_watcher_dirs_scanned", "upload dirs found by the last poll", ["bucket"]
+)
+uploads_pending = metrics.Gauge(
+    "dir_watcher_uploads_pending",
+    "uploads still uploading (uploading) or finished and waiting to be submitted (finished) after the last poll",
+    ["bucket", "state"],
+)
+submissions = metrics.Counter(
+    "dir_watcher_submissions_total",
+    "upload submission attempts by result (started, failed, dead_lettered)",
+    ["bucket", "result"],
+)
+
 logging.basicConfig(
     level=logging.DEBUG,
     format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
@@ -52,11 +93,16 @@ def get_cached_dirlist(watch_dir):
 
     (since the dirs are named after catsup upload uuids)
     """
-    ret = dirlist.find_one({"watch_dir": watch_dir}, {"dirs": 1})
-    if not ret:
-        return list()
-    else:
-        return list(ret.get("dirs"))
+    return mongo_store.get_items(processed_dirs, {"watch_dir": watch_dir})
+
+
+def get_processed_dirs(watch_dir, candidate_dirs):
+    """
+    get the subset of candidate_dirs that have already run
+    """
+    return mongo_store.find_existing(
+        processed_dirs, {"watch_dir": watch_dir}, candidate_dirs
+    )
 
 
 def add_to_cached_dirlist(
@@ -74,9 +120,7 @@ def add_to_cached_dirlist(
     apex_batch["id"] = str(apex_batch["id"])  # ugh
 
     logging.debug(f"adding {new_dir}")
-    dirlist.update_one(
-        {"watch_dir": watch_dir}, {"$push": {"dirs": new_dir}}, upsert=True
-    )
+    mongo_store.add_items(processed_dirs, {"watch_dir": watch_dir}, [new_dir])
     logging.info(f"{run_uuid}, {submitted_metadata}, {apex_batch}")
     metadata.update_one(
         {"catsup_uuid": new_dir},
@@ -94,6 +138,9 @@ def add_to_cached_dirlist(
 
 
 def get_ignore_list(watch_dir):
+    """
+    the old ignore list, replaced by submission_tracker's dead letters (see migrate_dirlist)
+    """
     r = ignore_list.find_one({"watch_dir": watch_dir}, {"ignore_list": 1})
     if r:
         return r.get("ignore_list", list())
@@ -101,40 +148,106 @@ def get_ignore_list(watch_dir):
         return list()
 
 
-def add_to_ignore_list(watch_dir, submission_uuid):
-    ignore_list.update_one(
-        {"watch_dir": watch_dir},
-        {"$push": {"ignore_list": submission_uuid}},
-        upsert=True,
-    )
-
-
 def remove_from_cached_dirlist(watch_dir, new_dir):
     logging.debug(f"removing {new_dir}")
-    dirlist.update_one(
-        {"watch_dir": watch_dir}, {"$pull": {"dirs": new_dir}}, upsert=True
+    mongo_store.remove_items(processed_dirs, {"watch_dir": watch_dir}, [new_dir])
+
+
+def migrate_dirlist(force=False):
+    """
+    copy the old per-watch_dir "dirs" arrays into the processed_dirs collection, and
+    the old ignore lists into the dead letters
+
+    watch runs this when it starts, so that old uploads aren't submitted again. It is
+    only done once per database unless force is set
+    """
+    n = mongo_store.run_migration(
+        mydb,
+        "dirlist",
+        lambda: mongo_store.migrate_array_documents(
+            dirlist, processed_dirs, ["watch_dir"], "dirs"
+        ),
+        force,
+    )
+    logging.info(f"migrated {n} dirs")
+    n = mongo_store.run_migration(
+        mydb, "ignore_list", submission_tracker.migrate_ignore_list, force
     )
+    logging.info(f"migrated {n} ignored dirs to dead letters")
 
 
-def which_pipeline_csv(watch_dir, new_dir):
-    rows = json.loads(get_and_format_metadata(watch_dir, new_dir))
-    for sample in rows.get("batch", dict()).get("samples", list()):
-        instrument = sample.get("instrument", dict())
-        platform = instrument.get("platform", str())
-        model = instrument.get("model", str())
-        platform_lower_words = [word.lower() for word in platform.split()]
-        model_lower_words = [word.lower() for word in platform.split()]
-        if "nanopore" in platform_lower_words:
-            return "nanopore-1"
-        if "nanopore" in model_lower_words:
-            return "nanopore-1"
-        if "illumina" in platform_lower_words:
-            return "illumina-1"
-        if "illumina" in model_lower_words:
-            return "illumina-1"
+def list_dead_letters(watch_dir=None):
+    """
+    list the uploads that dir_watcher has given up on (for watch_dir, or all)
+    """
+    for doc in submission_tracker.list_dead_letters(watch_dir):
+        dead_lettered = datetime.datetime.fromtimestamp(doc.get("dead_lettered_time", 0))
+        print(
+            f"{doc['watch_dir']}\t{doc['item']}\t{dead_lettered:%Y-%m-%d %H:%M:%S}\t"
+            f"attempts: {doc.get('attempts')}\t{doc.get('reason')}"
+        )
 
-    # default illumina
-    return "illumina-1"
+
+def show_dead_letter(watch_dir, new_dir):
+    """
+    show the dead letter, submission attempts and processed_dirs entry of an upload
+    """
+    return json.dumps(submission_tracker.show(watch_dir, new_dir), indent=4, default=str)
+
+
+def requeue(watch_dir, new_dir, delete_sp3data=False):
+    """
+    make dir_watcher submit an upload again (e.g. after fixing it)
+
+    delete_sp3data: also delete the upload's sp3data.csv, so its metadata is fetched
+    from the ORDS DB again
+    """
+    logging.info(f"requeueing {new_dir} in {watch_dir}")
+    submission_tracker.requeue(watch_dir, new_dir, delete_sp3data)
+
+
+def detect_pipeline(platform, model):
+    """
+    the pipeline for a sample's instrument platform/model, None if neither says
+    """
+    platform_lower_words = [word.lower() for word in platform.split()]
+    model_lower_words = [word.lower() for word in model.split()]
+    if "nanopore" in platform_lower_words:
+        return "nanopore-1"
+    if "nanopore" in model_lower_words:
+        return "nanopore-1"
+    if "illumina" in platform_lower_words:
+        return "illumina-1"
+    if "illumina" in model_lower_words:
+        return "illumina-1"
+    return None
+
+
+class ParsedUpload:
+    """
+    an upload's sp3data.csv, parsed once for every step of process_dir
+
+    fieldnames: the csv columns
+    metadata: the {"batch": ...} dict posted to apex (None if the csv has no rows)
+    pipeline: from the instrument platform/model of the first sample that has one
+    """
+
+    def __init__(self, fieldnames):
+        self.fieldnames = fieldnames
+        self.metadata = None
+        self.pipeline = None
+
+    def which_pipeline(self):
+        # default illumina
+        return self.pipeline or "illumina-1"
+
+
+def which_pipeline_csv(watch_dir, new_dir, upload=None):
+    if upload is None:
+        upload = parse_upload(watch_dir, new_dir)
+    if upload is None:
+        return "illumina-1"
+    return upload.which_pipeline()
 
 def which_pipeline_db(watch_dir, new_dir, metadata_dict = None):
     for sample in metadata_dict['samples'].values():
@@ -148,19 +261,25 @@ def which_pipeline_db(watch_dir, new_dir, metadata_dict = None):
     # default illumina
     return "illumina-1"
 
-def get_and_format_metadata(watch_dir, new_dir):
+def parse_upload(watch_dir, new_dir):
+    """
+    read an upload's sp3data.csv once into a ParsedUpload (None if there isn't one)
+    """
     data_file = Path(watch_dir) / new_dir / "sp3data.csv"
     logging.info(f"processing {data_file}")
     if not data_file.is_file():
-        logging.error(f"get_and_format_metadata: {data_file} not a file")
+        logging.error(f"parse_upload: {data_file} not a file")
         return
 
     with open(data_file, newline="") as f:
-        rows = list(csv.DictReader(f))
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        fieldnames = reader.fieldnames or list()
 
+    upload = ParsedUpload(fieldnames)
     if not rows:
-        logging.error(f"send_metadata_to_api: {data_file} no rows")
-        return
+        logging.error(f"parse_upload: {data_file} no rows")
+        return upload
 
     out = {"batch": {"samples": list()}}
 
@@ -204,6 +323,10 @@ def get_and_format_metadata(watch_dir, new_dir):
                 "flowcell": row.get("instrument_flowcell", ""),
             },
         }
+        if upload.pipeline is None:
+            upload.pipeline = detect_pipeline(
+                row.get("instrument_platform", ""), row.get("instrument_model", "")
+            )
         rows_for_sample = rows_by_sample.get(row.get("sample_uuid4"))
         if len(rows_for_sample) == 1:
             p["seReads"] = [
@@ -244,13 +367,19 @@ def get_and_format_metadata(watch_dir, new_dir):
     for k, v in metadata.items():
         out["batch"][k] = v
 
-    # dump to json in case it's used on the command-line. Python's output uses single quotes, which isn't valid json
-    return json.dumps(out)
+    upload.metadata = out
+    return upload
 
 
-submission_attempts = defaultdict(int)
+def get_and_format_metadata(watch_dir, new_dir):
+    upload = parse_upload(watch_dir, new_dir)
+    if not upload or upload.metadata is None:
+        return
+    # dump to json in case it's used on the command-line. Python's output uses single quotes, which isn't valid json
+    return json.dumps(upload.metadata)
 
 
+@tracing.traced()
 def process_dir(new_dir, watch_dir, bucket_name, apex_token, max_submission_attempts, workflow):
     """
     the watch process has detected a new upload. this processes it
@@ -265,125 +394,439 @@ def process_dir(new_dir, watch_dir, bucket_name, apex_token, max_submission_atte
         logging.info(f"dir_watcher: {new_dir} upload in progress?")
         return
 
-    if submission_attempts[new_dir] >= max_submission_attempts:
-        logging.warning(f"bad submission: {new_dir}")
-        add_to_ignore_list(str(watch_dir), new_dir)
+    if not submission_tracker.is_eligible(str(watch_dir), new_dir):
+        logging.info(f"dir_watcher: {new_dir} is dead lettered or waiting to be retried")
         return
 
-    submission_attempts[new_dir] += 1
-    logging.info(f"attempt {submission_attempts[new_dir]}")
+    attempt = submission_tracker.start_attempt(str(watch_dir), new_dir)
+    logging.info(f"attempt {attempt}")
 
+    try:
+        submit_dir(new_dir, watch_dir, bucket_name, apex_token, workflow)
+    except SubmissionFailed as e:
+        logging.error(f"{new_dir}: {e}")
+        dead_lettered = submission_tracker.failed(
+            str(watch_dir), new_dir, str(e), max_submission_attempts, e.permanent
+        )
+        submissions.inc(bucket=bucket_name, result="dead_lettered" if dead_lettered else "failed")
+        return False
+    except Exception as e:
+        logging.error(f"Error occurred processing {new_dir}.")
+        logging.error(e)
+        logging.error(traceback.format_exc())
+        dead_lettered = submission_tracker.failed(
+            str(watch_dir), new_dir, f"{type(e).__name__}: {e}", max_submission_attempts
+        )
+        submissions.inc(bucket=bucket_name, result="dead_lettered" if dead_lettered else "failed")
+        return False
+    submission_tracker.succeeded(str(watch_dir), new_dir)
+    submissions.inc(bucket=bucket_name, result="started")
+    return True  # we've restarted a run
+
+
+def submit_dir(new_dir, watch_dir, bucket_name, apex_token, workflow):
+    """
+    post an upload's metadata to apex and start its pipeline run
+
+    raises SubmissionFailed (or anything else) if the run wasn't started
+    """
     pipelines = ["illumina-1", "nanopore-1"]
     pipeline = pipelines[0]
     apex_batch = {}
     apex_samples = {}
     data = {}
-    try:
-        if (Path(watch_dir) / new_dir / "sp3data.csv").is_file():
-            with open(Path(watch_dir) / new_dir / "sp3data.csv", 'r') as infile:
-                reader = csv.DictReader(infile)
-                if len(reader.fieldnames) < 3:
-                    logging.error(f"Found APEX run {new_dir}, will not attempt to run again.")
-                    return False
-            
-            pipeline = which_pipeline_csv(watch_dir, new_dir)
+    if (Path(watch_dir) / new_dir / "sp3data.csv").is_file():
+        upload = parse_upload(watch_dir, new_dir)
+        if upload is None:
+            raise SubmissionFailed(f"{new_dir}: couldn't read sp3data.csv")
+        if not upload.fieldnames:
+            # empty or still being written, try again later
+            raise SubmissionFailed(f"{new_dir}: sp3data.csv has no header")
+        if len(upload.fieldnames) < 3:
+            # the submission_uuid4,sample_uuid4 csv written below for APEX runs
+            raise SubmissionFailed(
+                f"Found APEX run {new_dir}, will not attempt to run again.",
+                permanent=True,
+            )
+        if upload.metadata is None:
+            raise SubmissionFailed(f"{new_dir}: sp3data.csv has no rows")
+
+        pipeline = upload.which_pipeline()
+        if pipeline not in pipelines:
+            logging.warning(f"unknown pipeline: {pipeline} not in {pipelines}")
+
+        #        try:
+        # submit the pipeline run
+        # add to it list of stuff already run
+        data = upload.metadata
+        # logging.info(data)
+        apex_batch, apex_samples = db.post_metadata_to_apex(data, apex_token)
+        if not apex_batch:
+            raise SubmissionFailed("couldn't post the metadata to APEX")
+    else:
+        # Get metadata for batch from ORDS DB
+        batch_samples = db.get_batch_by_name(new_dir, apex_token)
+        if len(batch_samples.keys()) > 0:
+            pipeline = which_pipeline_db(watch_dir, new_dir, batch_samples)
             if pipeline not in pipelines:
                 logging.warning(f"unknown pipeline: {pipeline} not in {pipelines}")
-
-            #        try:
-            # submit the pipeline run
-            # add to it list of stuff already run
-            data_x = get_and_format_metadata(watch_dir, new_dir)
-            data = json.loads(data_x)
-            # logging.info(data)
-            apex_batch, apex_samples = db.post_metadata_to_apex(data, apex_token)
-            if not apex_batch:
-                return
+            # Write out submission_uuid4, sample_uuid4 to sp3data.csv
+            sp3data_csv = Path(watch_dir) / new_dir / "sp3data.csv"
+            out_fieldnames = ['submission_uuid4', 'sample_uuid4']
+            with open(sp3data_csv, 'w') as out_csv:
+                writer1 = csv.DictWriter(out_csv, fieldnames=out_fieldnames)
+                writer1.writeheader()
+                for sample in batch_samples['samples'].values():
+                    out = {
+                        'submission_uuid4' : sample['batchFileName'],
+                        'sample_uuid4' : sample['name']
+                    }
+                    writer1.writerow(out)
+            apex_batch = batch_samples
+            data = batch_samples
+            apex_samples = db.get_batch_samples(apex_batch['id'], apex_token)
         else:
-            # Get metadata for batch from ORDS DB
-            batch_samples = db.get_batch_by_name(new_dir, apex_token)
-            if len(batch_samples.keys()) > 0:
-                pipeline = which_pipeline_db(watch_dir, new_dir, batch_samples)
-                if pipeline not in pipelines:
-                    logging.warning(f"unknown pipeline: {pipeline} not in {pipelines}")
-                # Write out submission_uuid4, sample_uuid4 to sp3data.csv
-                sp3data_csv = Path(watch_dir) / new_dir / "sp3data.csv"
-                out_fieldnames = ['submission_uuid4', 'sample_uuid4']
-                with open(sp3data_csv, 'w') as out_csv:
-                    writer1 = csv.DictWriter(out_csv, fieldnames=out_fieldnames)
-                    writer1.writeheader()
-                    for sample in batch_samples['samples'].values():
-                        out = {
-                            'submission_uuid4' : sample['batchFileName'],
-                            'sample_uuid4' : sample['name']
-                        }
-                        writer1.writerow(out)
-                apex_batch = batch_samples
-                data = batch_samples
-                apex_samples = db.get_batch_samples(apex_batch['id'], apex_token)
-            else:
-                logging.error(f"No sp3data.csv and could not access ORDS DB for {new_dir}.")
-                return False
-        upload_bucket = db.get_output_bucket_from_input(bucket_name, apex_token)
-        if pipeline == "illumina-1":
-            if str(workflow).lower() == "sars-cov2_workflows":
-                ret = catsgo.run_covid_catsup(
-                    "oxforduni-gpas-sars-cov2-illumina",
-                    str(Path(watch_dir) / new_dir),
-                    bucket_name,
-                    upload_bucket,
-                    new_dir,
-                )
-            else:
-                ret = catsgo.run_covid_catsup(
-                    "oxforduni-ncov2019-artic-nf-illumina",
-                    str(Path(watch_dir) / new_dir),
-                    bucket_name,
-                    upload_bucket,
-                    new_dir,
-                )
-        elif pipeline == "nanopore-1":
-            if str(workflow).lower() == "sars-cov2_workflows":
-                ret = catsgo.run_covid_catsup(
-                    "oxforduni-gpas-sars-cov2-nanopore",
-                    str(Path(watch_dir) / new_dir),
-                    bucket_name,
-                    upload_bucket,
-                    new_dir,
-                )
-            else:
-                ret = catsgo.run_covid_catsup(
-                    "oxforduni-ncov2019-artic-nf-nanopore",
-                    str(Path(watch_dir) / new_dir),
-                    bucket_name,
-                    upload_bucket,
-                    new_dir,
-                )
+            raise SubmissionFailed(
+                f"No sp3data.csv and could not access ORDS DB for {new_dir}."
+            )
+    upload_bucket = db.get_output_bucket_from_input(bucket_name, apex_token)
+    if pipeline == "illumina-1":
+        if str(workflow).lower() == "sars-cov2_workflows":
+            ret = catsgo.run_covid_catsup(
+                "oxforduni-gpas-sars-cov2-illumina",
+                str(Path(watch_dir) / new_dir),
+                bucket_name,
+                upload_bucket,
+                new_dir,
+            )
         else:
-            logging.error("unknown pipeline: {pipeline}. This shouldn't be reachable")
-
-        logging.info(ret)
-        add_to_cached_dirlist(
-            str(watch_dir),
-            new_dir,
-            ret.get("run_uuid", ""),
-            apex_batch,
-            apex_samples,
-            data,
+            ret = catsgo.run_covid_catsup(
+                "oxforduni-ncov2019-artic-nf-illumina",
+                str(Path(watch_dir) / new_dir),
+                bucket_name,
+                upload_bucket,
+                new_dir,
+            )
+    elif pipeline == "nanopore-1":
+        if str(workflow).lower() == "sars-cov2_workflows":
+            ret = catsgo.run_covid_catsup(
+                "oxforduni-gpas-sars-cov2-nanopore",
+                str(Path(watch_dir) / new_dir),
+                bucket_name,
+                upload_bucket,
+                new_dir,
+            )
+        else:
+            ret = catsgo.run_covid_catsup(
+                "oxforduni-ncov2019-artic-nf-nanopore",
+                str(Path(watch_dir) / new_dir),
+                bucket_name,
+                upload_bucket,
+                new_dir,
+            )
+    else:
+        raise SubmissionFailed(f"unknown pipeline: {pipeline}. This shouldn't be reachable")
+
+    logging.info(ret)
+    add_to_cached_dirlist(
+        str(watch_dir),
+        new_dir,
+        ret.get("run_uuid", ""),
+        apex_batch,
+        apex_samples,
+        data,
+    )
+
+
+@tracing.traced()
+def list_upload_dirs(watch_dir):
+    """
+    list the upload directories in watch_dir with a single directory listing
+    """
+    with os.scandir(watch_dir) as entries:
+        return set([entry.name for entry in entries if entry.is_dir()])
+
+
+# watch_dir -> { upload dir: mtime } of upload dirs that were still uploading when last checked
+pending_dir_mtimes = defaultdict(dict)
+
+
+@tracing.traced()
+def find_finished_uploads(watch_dir, new_dirs, full_rescan=False, use_dir_mtimes=True):
+    """
+    return the dirs in new_dirs that have the upload_done.txt file, as a dict
+    of dir: upload_done.txt mtime
+
+    with use_dir_mtimes, a dir that was still uploading when it was last checked is
+    only checked again once its mtime has changed (or on a full rescan). Without it
+    (on fuse/network mounts, where a dir stat costs as much as statting upload_done.txt
+    and files written through s3 needn't change the dir mtime) every dir is checked
+    """
+    pending = pending_dir_mtimes[str(watch_dir)]
+    finished = dict()
+    for new_dir in new_dirs:
+        mtime = None
+        if use_dir_mtimes:
+            try:
+                mtime = (Path(watch_dir) / new_dir).stat().st_mtime
+            except OSError:
+                continue
+            if not full_rescan and pending.get(new_dir) == mtime:
+                continue
+        try:
+            done_mtime = (Path(watch_dir) / new_dir / "upload_done.txt").stat().st_mtime
+        except OSError:
+            if use_dir_mtimes:
+                pending[new_dir] = mtime
+            continue
+        pending.pop(new_dir, None)
+        finished[new_dir] = done_mtime
+
+    # forget dirs that have gone away or been processed
+    for new_dir in list(pending):
+        if new_dir not in new_dirs:
+            del pending[new_dir]
+    return finished
+
+
+def is_remote_fs(path):
+    """
+    whether path is on a network or fuse (e.g. s3fs) mount
+    """
+    path = os.path.realpath(path)
+    mount_point, fs_type = "", ""
+    with open("/proc/mounts") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 3:
+                continue
+            if (path == parts[1] or path.startswith(parts[1].rstrip("/") + "/")) and len(
+                parts[1]
+            ) > len(mount_point):
+                mount_point, fs_type = parts[1], parts[2]
+    return fs_type.startswith("fuse") or fs_type in ["nfs", "nfs4", "cifs", "smbfs"]
+
+
+def supports_inotify(path):
+    """
+    inotify only sees changes made through the local kernel, so it's no use on
+    network and fuse mounts
+    """
+    return bool(inotify_simple) and not is_remote_fs(path)
+
+
+class UploadEvents:
+    """
+    wakes the watch loop up as soon as a new upload dir or a file in an upload dir
+    (i.e. upload_done.txt) is created
+    """
+
+    def __init__(self, watch_dir):
+        self.inotify = inotify_simple.INotify()
+        self.flags = inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO
+        self.watches = dict()
+        self.add_watch(watch_dir)
+        self.watch_dir = Path(watch_dir)
+
+    def add_watch(self, path):
+        path = str(path)
+        if path in self.watches:
+            return
+        try:
+            self.watches[path] = self.inotify.add_watch(path, self.flags)
+        except OSError as e:
+            logging.warning(f"couldn't watch {path}: {e}")
+
+    def watch_uploads(self, upload_dirs):
+        """
+        watch exactly upload_dirs (plus watch_dir itself)
+        """
+        paths = set([str(self.watch_dir / d) for d in upload_dirs])
+        paths.add(str(self.watch_dir))
+        for path in list(self.watches):
+            if path not in paths:
+                try:
+                    self.inotify.rm_watch(self.watches[path])
+                except OSError:
+                    pass
+                del self.watches[path]
+        for path in paths:
+            self.add_watch(path)
+
+    def wait(self, timeout):
+        """
+        block until something is created or timeout seconds have passed
+        """
+        return bool(self.inotify.read(timeout=int(timeout * 1000), read_delay=1000))
+
+
+def get_flow_names(workflow):
+    """
+    the sp3 flows that process_dir starts runs on for workflow
+    """
+    if str(workflow).lower() == "sars-cov2_workflows":
+        return ["oxforduni-gpas-sars-cov2-illumina", "oxforduni-gpas-sars-cov2-nanopore"]
+    else:
+        return [
+            "oxforduni-ncov2019-artic-nf-illumina",
+            "oxforduni-ncov2019-artic-nf-nanopore",
+        ]
+
+
+def submit_finished_uploads(
+    finished_uploads,
+    watch_dir,
+    bucket_name,
+    apex_token,
+    max_submission_attempts,
+    workflow,
+    scheduler,
+    workers=4,
+):
+    """
+    run process_dir on finished uploads, oldest upload first, with up to workers
+    uploads being prepared and submitted at once, for as long as the scheduler allows
+    new runs to start
+
+    finished_uploads is a dict of dir: upload_done.txt mtime. Returns the number of runs started
+    """
+    queue = [(done_time, new_dir) for new_dir, done_time in finished_uploads.items()]
+    heapq.heapify(queue)
+    started = 0
+    with ThreadPoolExecutor(max_workers=int(workers)) as executor:
+        running = dict()
+        while queue or running:
+            while queue and len(running) < int(workers) and scheduler.acquire():
+                done_time, new_dir = heapq.heappop(queue)
+                running[
+                    executor.submit(
+                        tracing.propagate(process_dir),
+                        new_dir,
+                        watch_dir,
+                        bucket_name,
+                        apex_token,
+                        max_submission_attempts,
+                        workflow,
+                    )
+                ] = new_dir
+            if not running:
+                # no slots left, the rest will wait for the next poll
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                new_dir = running.pop(future)
+                r = None
+                try:
+                    r = future.result()
+                except Exception:
+                    # e.g. mongo errors from the submission tracker, outside
+                    # process_dir's own error handling
+                    logging.error(f"processing {new_dir} failed: {traceback.format_exc()}")
+                    sentry_sdk.capture_exception()
+                finally:
+                    # always give the slot back, or it's lost until the watcher restarts
+                    scheduler.release(started=bool(r))
+                if r:
+                    started += 1
+    if queue:
+        logging.info(f"{len(queue)} finished uploads waiting for a submission slot")
+    uploads_pending.set(len(queue), bucket=bucket_name, state="finished")
+    return started
+
+
+class BucketWatcher:
+    """
+    the state of watching one bucket's watch_dir, polled by watch (one bucket) or
+    watch_all (many buckets sharing one scheduler)
+    """
+
+    def __init__(
+        self,
+        watch_dir,
+        bucket_name,
+        max_submission_attempts=3,
+        flow="ncov2019-artic-nf",
+        full_rescan_every=10,
+        workers=4,
+    ):
+        self.watch_dir = Path(watch_dir)
+        self.bucket_name = bucket_name
+        self.max_submission_attempts = max_submission_attempts
+        self.flow = flow
+        self.full_rescan_every = int(full_rescan_every)
+        self.workers = workers
+        self.polls = 0
+
+    def poll(self, scheduler):
+        """
+        look for finished uploads and submit them. Returns the upload dirs that are
+        still uploading
+        """
+        with poll_seconds.time(bucket=self.bucket_name), tracing.span(
+            "dir_watcher.poll", bucket=self.bucket_name
+        ):
+            uploading_dirs = self.poll_once(scheduler)
+        uploads_pending.set(len(uploading_dirs), bucket=self.bucket_name, state="uploading")
+        return uploading_dirs
+
+    def poll_once(self, scheduler):
+        # get all directories in bucket
+        # note that directories are named after submission uuids, so this is effectively a list of submission uuids
+        candidate_dirs = list_upload_dirs(self.watch_dir)
+        dirs_scanned.set(len(candidate_dirs), bucket=self.bucket_name)
+        # get directories/submissions that have already been processed
+        cached_dirlist = get_processed_dirs(str(self.watch_dir), candidate_dirs)
+        # submissions to be processed are those that are new and have not beek marked as failed
+        new_dirs = candidate_dirs.difference(cached_dirlist)
+        # get directories/submissions that have failed (and not been migrated from the old ignore list yet)
+        new_dirs = new_dirs.difference(get_ignore_list(str(self.watch_dir)))
+        new_dirs = new_dirs.difference(
+            submission_tracker.get_dead_lettered(str(self.watch_dir), new_dirs)
         )
-        return True  # we've restarted a run
-    except Exception as e:
-        logging.error(f"Error occurred processing {new_dir}.")
-        logging.error(e)
-        logging.error(traceback.format_exc())
-        return False
+        # or failed recently and are waiting to be retried
+        new_dirs = new_dirs.difference(
+            submission_tracker.get_backing_off(str(self.watch_dir), new_dirs)
+        )
+        # of those, only the uploads that have finished are ready to run
+        finished_uploads = find_finished_uploads(
+            self.watch_dir,
+            new_dirs,
+            full_rescan=(self.polls % self.full_rescan_every == 0),
+            # checked every poll, as a bucket can be mounted after the watcher starts
+            use_dir_mtimes=not is_remote_fs(self.watch_dir),
+        )
+        self.polls += 1
+
+        if finished_uploads:
+            apex_token = db.get_apex_token()
+            submit_finished_uploads(
+                finished_uploads,
+                self.watch_dir,
+                self.bucket_name,
+                apex_token,
+                self.max_submission_attempts,
+                self.flow,
+                scheduler,
+                self.workers,
+            )
+        else:
+            uploads_pending.set(0, bucket=self.bucket_name, state="finished")
+        return new_dirs.difference(finished_uploads)
 
 
 def watch(
     watch_dir="/data/inputs/s3/oracle-test",
     bucket_name="catsup-test",
     max_submission_attempts=3,
-    flow="ncov2019-artic-nf"
+    flow="ncov2019-artic-nf",
+    poll_interval=60,
+    full_rescan_every=10,
+    polling_only=False,
+    max_in_flight=20,
+    starts_per_minute=1.0,
+    burst=1,
+    workers=4,
+    metrics_port=None,
 ):
     """
     watch watch_dir for new directories that have the upload_done.txt file (signaling that an upload was successful)
@@ -391,38 +834,150 @@ def watch(
     watch_dir example: /data/inputs/s3/oracle-test (for the catsup-test bucket. In the future we should probably name the directories the same as the bucket name!
     bucket_name: the bucket name that's mounted in the watch_dir directory (used by the pipeline to fetch the sample files)
     flow: currently a choice between ncov2019-artic-nf and sars-cov2_workflows
+    poll_interval: seconds between scans (the longest wait when inotify is used)
+    full_rescan_every: on local filesystems, re-check all unfinished uploads every this many polls, even if their mtime hasn't changed
+        (on fuse and network mounts they are all checked every poll)
+    polling_only: don't use inotify even if the filesystem supports it
+    max_in_flight: don't start a run while sp3 has this many runs of the flow running (0 for no limit)
+    starts_per_minute, burst: rate at which new runs can be started, this prevents the
+        system from being overwhelmed with nextflow starting
+    workers: number of uploads prepared and submitted at once
+    metrics_port: serve prometheus metrics on http://127.0.0.1:<metrics_port>/metrics
     """
     print(doc)
+    metrics.serve(metrics_port)
+    migrate_dirlist()
     watch_dir = Path(watch_dir)
     if not watch_dir.is_dir():
         logging.error(f"{watch_dir} is not a directory")
         sys.exit(1)
 
+    events = None
+    if not polling_only and supports_inotify(watch_dir):
+        logging.info(f"using inotify to watch {watch_dir}")
+        events = UploadEvents(watch_dir)
+
+    scheduler = SubmissionScheduler(
+        get_flow_names(flow),
+        max_in_flight=max_in_flight,
+        starts_per_minute=starts_per_minute,
+        burst=burst,
+    )
+    watcher = BucketWatcher(
+        watch_dir,
+        bucket_name,
+        max_submission_attempts=max_submission_attempts,
+        flow=flow,
+        full_rescan_every=full_rescan_every,
+        workers=workers,
+    )
+
     while True:
-        # get all directories in bucket
-        # note that directories are named after submission uuids, so this is effectively a list of submission uuids
-        candidate_dirs = set([x.name for x in watch_dir.glob("*") if x.is_dir()])
-        # get directories/submissions that have already been processed
-        cached_dirlist = set(get_cached_dirlist(str(watch_dir)))
-        # get directories/submissions that have failed
-        bad_submission_uuids = set(get_ignore_list(str(watch_dir)))
-        # submissions to be processed are those that are new and have not beek marked as failed
-        new_dirs = candidate_dirs.difference(cached_dirlist)
-        new_dirs = new_dirs.difference(bad_submission_uuids)
+        uploading_dirs = watcher.poll(scheduler)
 
-        if new_dirs:
-            apex_token = db.get_apex_token()
-        for new_dir in new_dirs:  #  new_dir is the catsup upload uuid
-            r = process_dir(
-                new_dir, watch_dir, bucket_name, apex_token, max_submission_attempts, flow
-            )
-            if r:
-                # if we've started a run then stop processing and go to sleep. This prevents
-                # the system from being overwhelmed with nextflow starting
-                break
+        if events:
+            # wake up when upload_done.txt appears in one of the uploads in progress
+            events.watch_uploads(uploading_dirs)
+            print(f"waiting up to {poll_interval} for new uploads")
+            events.wait(int(poll_interval))
+        else:
+            print(f"sleeping for {poll_interval}")
+            time.sleep(int(poll_interval))
+
+
+def read_buckets_file(buckets_file):
+    """
+    bucket names, separated by commas and/or newlines (as used by create_all_dir_watchers.sh)
+    """
+    with open(buckets_file) as f:
+        return [b.strip() for b in f.read().replace("\n", ",").split(",") if b.strip()]
+
+
+def poll_bucket(watcher, scheduler):
+    """
+    poll one bucket, logging (rather than raising) errors so that one bad bucket or
+    mount doesn't stop the others
+    """
+    try:
+        if not watcher.watch_dir.is_dir():
+            logging.error(f"{watcher.watch_dir} is not a directory, skipping {watcher.bucket_name}")
+            return
+        watcher.poll(scheduler)
+    except Exception:
+        logging.error(f"polling {watcher.bucket_name} failed: {traceback.format_exc()}")
+        sentry_sdk.capture_exception()
+
+
+def watch_all(
+    buckets_file="buckets.txt",
+    mount_root="/data/inputs/s3",
+    max_submission_attempts=3,
+    flow="ncov2019-artic-nf",
+    poll_interval=60,
+    full_rescan_every=10,
+    max_in_flight=20,
+    starts_per_minute=1.0,
+    burst=1,
+    workers=4,
+    poll_workers=8,
+    metrics_port=None,
+):
+    """
+    watch every bucket in buckets_file (mounted at mount_root/<bucket>) from one process,
+    instead of one dir_watcher@<bucket> service per bucket
+
+    the buckets share one submission scheduler (so max_in_flight and starts_per_minute
+    are for all buckets together), apex token, mongo client and sp3 session. Buckets
+    are polled by up to poll_workers threads; a bucket whose last poll hasn't finished
+    (e.g. a hung mount) is skipped until it does. buckets_file is re-read every poll
+    so buckets can be added without a restart. The other options are as for watch
+    (polling only, no inotify)
+    """
+    print(doc)
+    metrics.serve(metrics_port)
+    migrate_dirlist()
+    scheduler = SubmissionScheduler(
+        get_flow_names(flow),
+        max_in_flight=max_in_flight,
+        starts_per_minute=starts_per_minute,
+        burst=burst,
+    )
+    watchers = dict()
+    polls = dict()
+    executor = ThreadPoolExecutor(max_workers=int(poll_workers))
+
+    while True:
+        try:
+            buckets = read_buckets_file(buckets_file)
+        except OSError as e:
+            logging.error(f"couldn't read {buckets_file}: {e}")
+            buckets = list(watchers)
+
+        for bucket in buckets:
+            if bucket not in watchers:
+                logging.info(f"watching {bucket}")
+                watchers[bucket] = BucketWatcher(
+                    Path(mount_root) / bucket,
+                    bucket,
+                    max_submission_attempts=max_submission_attempts,
+                    flow=flow,
+                    full_rescan_every=full_rescan_every,
+                    workers=workers,
+                )
+            if bucket in polls and not polls[bucket].done():
+                logging.warning(f"previous poll of {bucket} is still running, skipping it")
+                continue
+            polls[bucket] = executor.submit(poll_bucket, watchers[bucket], scheduler)
+
+        for bucket in list(watchers):
+            if bucket not in buckets and (bucket not in polls or polls[bucket].done()):
+                logging.info(f"no longer watching {bucket}")
+                del watchers[bucket]
+                polls.pop(bucket, None)
+
+        print(f"sleeping for {poll_interval}")
+        time.sleep(int(poll_interval))
 
-        print("sleeping for 60")
-        time.sleep(60)
 
 def get_apex_token():
     return db.get_apex_token()
@@ -432,7 +987,12 @@ if __name__ == "__main__":
     argh.dispatch_commands(
         [
             watch,
+            watch_all,
             remove_from_cached_dirlist,
+            migrate_dirlist,
+            list_dead_letters,
+            show_dead_letter,
+            requeue,
             get_apex_token,
             process_dir,
             get_and_format_metadata,
@@ -14,7 +14,9 @@ import json
 import datetime
 from pathlib import Path
 import hashlib
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import argh
 import pymongo
@@ -22,6 +24,9 @@ import requests
 
 import db
 import catsgo
+import metrics
+import mongo_store
+import tracing
 import utils
 import sentry_sdk
 
@@ -36,16 +41,50 @@ sentry_sdk.init(
     traces_sample_rate=config["sentry_traces_sample_rate"]
 )
 
-myclient = pymongo.MongoClient("mongodb://localhost:27017/")
+myclient = pymongo.MongoClient(
+    "mongodb://localhost:27017/", event_listeners=metrics.mongo_listeners
+)
 mydb = myclient["ena_runner"]
 dirlist = mydb["dirlist"]
+processed_samples = mydb["processed_samples"]
 ignore_list = mydb["ignore_list"]
+ignored_samples = mydb["ignored_samples"]
+md5_cache = mydb["md5_cache"]
+shard_signatures = mydb["shard_signatures"]
+
+mongo_store.ensure_indexes(processed_samples, ["sample_method", "path"], ["sample_method"])
+mongo_store.ensure_indexes(ignored_samples, ["sample_method", "path"], ["sample_method"])
+md5_cache.create_index("path", unique=True)
+shard_signatures.create_index(
+    [("sample_method", pymongo.ASCENDING), ("path", pymongo.ASCENDING)], unique=True
+)
 
 mydb2 = myclient["dir_watcher"]
 dirwatcher_metadata = mydb2["metadata"]
 
 config = utils.load_config("config.json")
 
+scan_seconds = metrics.Histogram(
+    "ena_runner_scan_seconds",
+    "time taken to scan a sample method's tree and check which samples are new",
+    ["sample_method"],
+)
+samples_scanned = metrics.Gauge(
+    "ena_runner_samples_scanned", "samples found in changed shards by the last scan", ["sample_method"]
+)
+samples_pending = metrics.Gauge(
+    "ena_runner_samples_pending", "new samples found by the last scan", ["sample_method"]
+)
+batches_submitted = metrics.Counter(
+    "ena_runner_batches_total", "batches submitted", ["sample_method"]
+)
+samples_submitted = metrics.Counter(
+    "ena_runner_samples_total", "samples submitted", ["sample_method"]
+)
+md5_seconds = metrics.Histogram(
+    "ena_runner_batch_md5_seconds", "time taken to md5 the read files of a batch"
+)
+
 logging.basicConfig(
     level=logging.DEBUG,
     format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
@@ -57,16 +96,22 @@ def get_cached_dirlist(sample_method, path):
     """
     get the list of Samples that have already run from a sample_method (illumina or nanopore) and path (prefix/shard)
     """
-    ret = dirlist.find_one(
-        {"sample_method": sample_method, "path": path}, {"samples": 1}
+    return mongo_store.get_items(
+        processed_samples, {"sample_method": sample_method, "path": path}
     )
-    if not ret:
-        return list()
-    else:
-        return list(ret.get("samples"))
-    # return list(
-    #    dirlist.find({"sample_method": sample_method, "path": path}, {"samples": 1})
-    # )
+
+
+def get_done_samples(sample_method, candidates):
+    """
+    get the candidates that have already been batched or ignored, with one query per
+    collection however many paths (prefix/shard) they are spread over
+
+    candidates are (path, sample) pairs
+    """
+    scope = {"sample_method": sample_method}
+    return mongo_store.find_existing_grouped(
+        processed_samples, scope, "path", candidates
+    ).union(mongo_store.find_existing_grouped(ignored_samples, scope, "path", candidates))
 
 
 def add_to_cached_dirlist(sample_method, path, samples):
@@ -75,38 +120,197 @@ def add_to_cached_dirlist(sample_method, path, samples):
     """
 
     logging.debug(f"adding {samples} to {sample_method}, {path}")
-    dirlist.update_one(
-        {"sample_method": sample_method, "path": path},
-        {"$push": {"samples": {"$each": samples}}},
-        upsert=True,
+    mongo_store.add_items(
+        processed_samples, {"sample_method": sample_method, "path": path}, samples
+    )
+
+
+def migrate_dirlist(force=False):
+    """
+    copy the old per-shard "samples" and "ignore_list" arrays into the
+    processed_samples and ignored_samples collections
+
+    watch runs this when it starts, so that old samples aren't batched again. It is
+    only done once per database unless force is set
+    """
+    n = mongo_store.run_migration(
+        mydb,
+        "dirlist",
+        lambda: mongo_store.migrate_array_documents(
+            dirlist, processed_samples, ["sample_method", "path"], "samples"
+        ),
+        force,
     )
+    logging.info(f"migrated {n} samples")
+    n = mongo_store.run_migration(
+        mydb,
+        "ignore_list",
+        lambda: mongo_store.migrate_array_documents(
+            ignore_list, ignored_samples, ["sample_method", "path"], "ignore_list"
+        ),
+        force,
+    )
+    logging.info(f"migrated {n} ignored samples")
 
 
-def get_md5_file_hash(file_path):
+@tracing.traced()
+def get_md5_file_hash(file_path, chunk_size=1024 * 1024):
+    """
+    md5 a file in fixed size chunks so memory use doesn't depend on the file size
+    """
+    md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        bytes = f.read()
-        return hashlib.md5(bytes).hexdigest()
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-def get_ignore_list(sample_method, path):
-    r = ignore_list.find_one({"sample_method": sample_method, "path": path}, {"ignore_list": 1})
-    if r:
-        return r.get("ignore_list", list())
+
+def get_cached_md5_file_hash(file_path):
+    """
+    get the md5 of a file, only hashing it if it's not in the md5 cache for its current size and mtime
+
+    if ENA_trust_md5_sidecar is set in the config, a .md5 file next to the fastq is used instead of hashing
+    """
+    file_path = str(file_path)
+    st = os.stat(file_path)
+    r = md5_cache.find_one({"path": file_path}, {"size": 1, "mtime": 1, "md5": 1})
+    if r and r.get("size") == st.st_size and r.get("mtime") == st.st_mtime:
+        return r["md5"]
+
+    sidecar = Path(file_path).with_suffix(".md5")
+    if config.get("ENA_trust_md5_sidecar", False) and sidecar.is_file():
+        md5 = sidecar.read_text().strip()
     else:
-        return list()
+        md5 = get_md5_file_hash(file_path)
 
-def add_to_ignore_list(sample_method, path, samples):
-    ignore_list.update_one(
-        {"sample_method": sample_method, "path": path},
-        {"$push": {"ignore_list": samples}},
+    md5_cache.update_one(
+        {"path": file_path},
+        {"$set": {"size": st.st_size, "mtime": st.st_mtime, "md5": md5}},
         upsert=True,
     )
+    return md5
+
+
+@tracing.traced()
+def get_md5_file_hashes(file_paths):
+    """
+    md5 many files at once with a pool of ENA_md5_workers (default 8) workers
+
+    returns a dict of path: md5
+    """
+    file_paths = [str(p) for p in file_paths]
+    with ThreadPoolExecutor(max_workers=int(config.get("ENA_md5_workers", 8))) as executor:
+        return dict(zip(file_paths, executor.map(tracing.propagate(get_cached_md5_file_hash), file_paths)))
+
+
+def get_ignore_list(sample_method, path):
+    return mongo_store.get_items(
+        ignored_samples, {"sample_method": sample_method, "path": path}
+    )
+
+def add_to_ignore_list(sample_method, path, samples):
+    if isinstance(samples, str):
+        samples = [samples]
+    mongo_store.add_items(
+        ignored_samples, {"sample_method": sample_method, "path": path}, samples
+    )
+
+
+@tracing.traced()
+def list_subdirs(path):
+    """
+    the subdirectories of path, from a single directory listing
+    """
+    try:
+        with os.scandir(path) as entries:
+            return [entry for entry in entries if entry.is_dir()]
+    except OSError as e:
+        logging.error(f"couldn't list {path}: {e}")
+        return list()
+
+
+def scan_sample(sample_dir):
+    """
+    list a sample directory once and return its manifest:
+
+    {"name": sample, "path": Path, "fastq": [fastq.gz Paths], "md5": [fastq.md5 Paths]}
+    """
+    sample_dir = Path(sample_dir)
+    manifest = {"name": sample_dir.name, "path": sample_dir, "fastq": list(), "md5": list()}
+    try:
+        with os.scandir(sample_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".fastq.gz"):
+                    manifest["fastq"].append(Path(entry.path))
+                elif entry.name.endswith(".fastq.md5"):
+                    manifest["md5"].append(Path(entry.path))
+    except OSError as e:
+        logging.error(f"couldn't list {sample_dir}: {e}")
+    return manifest
+
+
+def get_shard_signatures(sample_method):
+    return {
+        d["path"]: d["signature"]
+        for d in shard_signatures.find({"sample_method": sample_method}, {"path": 1, "signature": 1})
+    }
+
+
+def save_shard_signatures(sample_method, signatures):
+    ops = [
+        pymongo.UpdateOne(
+            {"sample_method": sample_method, "path": path},
+            {"$set": {"signature": signature}},
+            upsert=True,
+        )
+        for path, signature in signatures.items()
+    ]
+    if ops:
+        shard_signatures.bulk_write(ops, ordered=False)
+
+
+def scan_ena_tree(sample_method_dir, signatures=None, full_rescan=False):
+    """
+    walk sample_method/prefix/shard/sub_shard/sample in a single pass, listing every
+    directory once
+
+    yields (sub_shard path, signature, {sample: manifest}) for every sub_shard, skipping
+    the ones whose signature (a hash of its sorted sample dir names, so that it doesn't
+    depend on s3fs updating directory mtimes) is the same as in signatures unless
+    full_rescan is set. Only samples with at least one fastq.gz are included
+    """
+    signatures = signatures or dict()
+    # These are the prefixs of the sample asscessions (E.G. ERR408 has, in shards (000-010), samples ERR4080000 - ERR4089999)
+    for prefix_dir in list_subdirs(sample_method_dir):
+        for shard_dir in list_subdirs(prefix_dir.path):
+            for sub_shard_dir in list_subdirs(shard_dir.path):
+                path = f"{prefix_dir.name}/{shard_dir.name}/{sub_shard_dir.name}"
+                sample_dirs = list_subdirs(sub_shard_dir.path)
+                signature = hashlib.sha1(
+                    "\n".join(sorted(d.name for d in sample_dirs)).encode()
+                ).hexdigest()
+                if not full_rescan and signatures.get(path) == signature:
+                    continue
+                manifests = dict()
+                for sample_dir in sample_dirs:
+                    manifest = scan_sample(sample_dir.path)
+                    if manifest["fastq"]:
+                        manifests[sample_dir.name] = manifest
+                yield path, signature, manifests
+
 
 def create_batch(
-    exisiting_dirs, size_batch, new_dirs=None, new_dir_prefix=None, sample_method=None, watch_dir=None,
+    exisiting_dirs, size_batch, new_dirs=None, new_dir_prefix=None, sample_method=None, watch_dir=None, manifests=None,
 ):
+    """
+    manifests are the sample manifests of new_dir_prefix from scan_ena_tree. Samples
+    without one are scanned here
+    """
     if new_dirs:
+        invalid_samples = list()
         while len(exisiting_dirs) < size_batch and len(new_dirs) > 0:
             dir = new_dirs.pop()
+            manifest = (manifests or dict()).get(dir) or scan_sample(new_dir_prefix / dir)
             metadata = utils.get_ena_metadata_from_csv(dir, watch_dir)
             validSample = True
 
@@ -117,14 +321,14 @@ def create_batch(
                     # ILLUMINA
                     if (sample_method == "illumina") or str(metadata["instrument_platform"]).lower() == "illumina":
                         # check both fastqs are avalaible
-                        if len(set((new_dir_prefix / dir).glob("*.fastq.md5"))) != 2:
+                        if len(manifest["md5"]) != 2:
                             print(f"{dir} is not a valid illumina sample, only one on the fastqs is avalaible.")
                             validSample = False
 
                     # NANOPORE
                     elif (sample_method == "nanopore") or str(metadata["instrument_platform"]).lower() == "nanopore":
                         # check that only one fastq exists
-                        if len(set((new_dir_prefix / dir).glob("*.fastq.md5"))) != 1:
+                        if len(manifest["md5"]) != 1:
                             print(f"{dir} is not a valid nanopore sample, there is more than one fastq.")
                             validSample = False
  
@@ -138,9 +342,9 @@ def create_batch(
                 if validSample:
                     # Check md5 sums of sequences against ENA values stored in the .md5 files
                     # this is done because read-it-and-keep has been run across the files
-                    for file in (new_dir_prefix / dir).glob("*.fastq.gz"):
+                    for file in manifest["fastq"]:
                         # get the md5 from the file
-                        if not file.with_suffix(".md5").exists():
+                        if file.with_suffix(".md5") not in manifest["md5"]:
                             print(f"md5 checksum does not exist for {file}")
                             break
                         with file.with_suffix(".md5").open(mode="rb") as md5_file:
@@ -167,10 +371,13 @@ def create_batch(
             
             if not validSample:
                 logging.info(f"Sample {dir} is not valid, skipping and adding to ignore list")
-                # horrible hack to get the path
-                path = new_dir_prefix.parent.parent.name + "/" + new_dir_prefix.parent.name + "/" + new_dir_prefix.name
-                # add the sample to the completion list, so that it is ignored in future
-                add_to_ignore_list(sample_method, str(path), dir)
+                invalid_samples.append(dir)
+
+        if invalid_samples:
+            # horrible hack to get the path
+            path = new_dir_prefix.parent.parent.name + "/" + new_dir_prefix.parent.name + "/" + new_dir_prefix.name
+            # add the samples to the completion list, so that they are ignored in future
+            add_to_ignore_list(sample_method, str(path), invalid_samples)
 
         # No new dirs, return working lists
         return (exisiting_dirs, new_dirs)
@@ -180,11 +387,24 @@ def create_batch(
 
 def process_batch(sample_method, samples_to_submit, batch_dir, workflow):
     print(f"processing {samples_to_submit}")
+    batches_submitted.inc(sample_method=sample_method.name)
+    samples_submitted.inc(len(samples_to_submit), sample_method=sample_method.name)
     samples = list()
     sample_shards = dict()
     batch_name = "ENA-" + str(uuid.uuid4())[:7]
     submission_name = f"Entry for ENA sample processing - {batch_name}"
 
+    # hash all the read files of the batch up front, in parallel
+    read_files = list()
+    for sample, ena_metadata in samples_to_submit:
+        if sample_method.name == "illumina":
+            read_files.append(Path(sample) / (sample.name + "_1.fastq.gz"))
+            read_files.append(Path(sample) / (sample.name + "_2.fastq.gz"))
+        elif sample_method.name == "nanopore":
+            read_files.append(Path(sample) / (sample.name + ".fastq.gz"))
+    with md5_seconds.time():
+        md5s = get_md5_file_hashes(read_files)
+
     for sample, ena_metadata in samples_to_submit:
         p = {
             "name": sample.name,
@@ -207,9 +427,9 @@ def process_batch(sample_method, samples_to_submit, batch_dir, workflow):
             p["pe_reads"] = [
                 {
                     "r1_uri": str(Path(sample) / (sample.name + "_1.fastq.gz")),
-                    "r1_md5": get_md5_file_hash(str(Path(sample) / (sample.name + "_1.fastq.gz"))),
+                    "r1_md5": md5s[str(Path(sample) / (sample.name + "_1.fastq.gz"))],
                     "r2_uri": str(Path(sample) / (sample.name + "_2.fastq.gz")),
-                    "r2_md5": get_md5_file_hash(str(Path(sample) / (sample.name + "_2.fastq.gz"))),
+                    "r2_md5": md5s[str(Path(sample) / (sample.name + "_2.fastq.gz"))],
                 }
             ]
             p["se_reads"] = []
@@ -217,7 +437,7 @@ def process_batch(sample_method, samples_to_submit, batch_dir, workflow):
             p["se_reads"] = [
                 {
                     "uri": str(Path(sample) / (sample.name + ".fastq.gz")),
-                    "md5": get_md5_file_hash(str(Path(sample) / (sample.name + ".fastq.gz"))),
+                    "md5": md5s[str(Path(sample) / (sample.name + ".fastq.gz"))],
                 }
             ]
             p["pe_reads"] = []
@@ -250,8 +470,9 @@ def process_batch(sample_method, samples_to_submit, batch_dir, workflow):
         sample_method.parent.parent.name, apex_token
     )
 
-    for path, sample_list in sample_shards.items():
-        add_to_cached_dirlist(sample_method.name, path, sample_list)
+    mongo_store.add_grouped_items(
+        processed_samples, {"sample_method": sample_method.name}, "path", sample_shards
+    )
 
     # Add to batch_dir
     ena_batch_csv = Path(batch_dir) / f"{batch_name}.csv"
@@ -299,87 +520,77 @@ def process_batch(sample_method, samples_to_submit, batch_dir, workflow):
     return []
 
 
-def watch(watch_dir="", batch_dir="", size_batch=200, flow="ncov2019-artic-nf"):
-    """ """
+def watch(watch_dir="", batch_dir="", size_batch=200, flow="ncov2019-artic-nf", full_rescan_every=10, metrics_port=None):
+    """
+    full_rescan_every: look inside every sub_shard every this many polls, even the ones
+    that haven't changed since they were last looked at
+    metrics_port: serve prometheus metrics on http://127.0.0.1:<metrics_port>/metrics
+    """
     print(doc)
+    metrics.serve(metrics_port)
+    migrate_dirlist()
     watch_dir = Path(watch_dir)
     if not watch_dir.is_dir():
         logging.error(f"{watch_dir} is not a directory")
         sys.exit(1)
 
+    poll = 0
     while True:
+        full_rescan = poll % int(full_rescan_every) == 0
+        poll += 1
         # ENA bucket will have illumina and nanopore data
         for sample_method in [watch_dir / "nanopore", watch_dir / "illumina"]:
             samples_to_submit = []
-            # These are the prefixs of the sample asscessions (E.G. ERR408 has, in shards (000-010), samples ERR4080000 - ERR4089999)
-            for prefix_dir in set(
-                [x.name for x in sample_method.glob("*") if x.is_dir()]
+            # signatures of the sub_shards looked at in this pass. They're only saved once
+            # all of their new samples have been batched or ignored
+            scanned_signatures = dict()
+            with scan_seconds.time(sample_method=sample_method.name), tracing.span(
+                "ena_runner.scan", sample_method=sample_method.name
             ):
-                # Go through each shard seperately
-                for shard_dir in set(
-                    [
-                        y.name
-                        for y in (watch_dir / sample_method / prefix_dir).glob("*")
-                        if y.is_dir()
-                    ]
-                ):
-                    for sub_shard_dir in set(
-                        [
-                            w.name
-                            for w in (watch_dir / sample_method / prefix_dir / shard_dir).glob("*")
-                            if w.is_dir()
-                        ]
-                    ):
-                        # Get all sample directories (each of which should only have one sample!)
-                        candidate_dirs = set(
-                            [
-                                z.name
-                                for z in (watch_dir / sample_method / prefix_dir / shard_dir / sub_shard_dir).glob("*")
-                                if z.is_dir()
-                                and len(set((watch_dir / sample_method / prefix_dir / shard_dir / sub_shard_dir / z).glob("*.fastq.gz"))) >= 1
-                            ]
+                scanned = list(
+                    scan_ena_tree(
+                        sample_method, get_shard_signatures(sample_method.name), full_rescan
+                    )
+                )
+                # get samples that have already been processed or have been marked as failed,
+                # for all the scanned shards at once
+                candidates = [
+                    (path, sample) for path, _, manifests in scanned for sample in manifests
+                ]
+                done_samples = get_done_samples(sample_method.name, candidates)
+            samples_scanned.set(len(candidates), sample_method=sample_method.name)
+            samples_pending.set(
+                len(candidates) - len(done_samples), sample_method=sample_method.name
+            )
+            for path, signature, manifests in scanned:
+                scanned_signatures[path] = signature
+                # Get all sample directories (each of which should only have one sample!)
+                # submissions to be processed are those that are new and have not been marked as failed or finished
+                new_dirs = set(
+                    [sample for sample in manifests if (path, sample) not in done_samples]
+                )
+
+                if new_dirs:
+                    new_dirs = list(new_dirs)
+                    while len(new_dirs) > 0:
+                        # Assemble batch after checking No. of files and md5 sums are correct
+                        (samples_to_submit, new_dirs) = create_batch(
+                            samples_to_submit,
+                            size_batch,
+                            new_dirs,
+                            sample_method / path,
+                            sample_method.name,
+                            watch_dir,
+                            manifests,
                         )
-                        # get directories/submissions that have already been processed
-                        cached_dirlist = set(
-                            get_cached_dirlist(
-                                sample_method.name,
-                                str(Path(prefix_dir) / shard_dir / sub_shard_dir),
+
+                        # Check if submitting
+                        if len(samples_to_submit) >= size_batch:
+                            samples_to_submit = process_batch(
+                                sample_method, samples_to_submit, batch_dir, flow
                             )
-                        )
-                        # submissions to be processed are those that are new and have not been marked as failed or finished
-                        bad_submission_uuids = set(
-                            get_ignore_list(sample_method.name, 
-                            str(Path(prefix_dir) / shard_dir / sub_shard_dir))
-                        )
-                        logging.debug(f"{bad_submission_uuids} are being ignored as they have previously been detected as invalid")
-                        new_dirs = candidate_dirs.difference(cached_dirlist)
-                        new_dirs = new_dirs.difference(bad_submission_uuids)
-                        
-
-                        if new_dirs:
-                            new_dirs = list(new_dirs)
-                            while len(new_dirs) > 0:
-                                # Assemble batch after checking No. of files and md5 sums are correct
-                                (samples_to_submit, new_dirs) = create_batch(
-                                    samples_to_submit,
-                                    size_batch,
-                                    new_dirs,
-                                    watch_dir
-                                    / sample_method
-                                    / prefix_dir
-                                    / shard_dir
-                                    / sub_shard_dir,
-                                    sample_method.name,
-                                    watch_dir,
-                                )
-
-                                # Check if submitting
-                                if len(samples_to_submit) >= size_batch:
-                                    samples_to_submit = process_batch(
-                                        sample_method, samples_to_submit, batch_dir, flow
-                                    )
-                                    print(f'sleeping for {config["ENA_sleep_time"]}')
-                                    time.sleep(int(config["ENA_sleep_time"]))
+                            print(f'sleeping for {config["ENA_sleep_time"]}')
+                            time.sleep(int(config["ENA_sleep_time"]))
             # Should submit leftovers for this sample_method to avoid mixing.
             if len(samples_to_submit) >= 1:
                 samples_to_submit = process_batch(
@@ -387,6 +598,7 @@ def watch(watch_dir="", batch_dir="", size_batch=200, flow="ncov2019-artic-nf"):
                 )
                 print(f'sleeping for {config["ENA_sleep_time"]}')
                 time.sleep(int(config["ENA_sleep_time"]))
+            save_shard_signatures(sample_method.name, scanned_signatures)
         print("sleeping for 60")
         time.sleep(60)
 
@@ -396,5 +608,6 @@ if __name__ == "__main__":
     argh.dispatch_commands(
         [
             watch,
+            migrate_dirlist,
         ]
     )
@@ -0,0 +1,207 @@
+doc = """
+in-process counters, gauges and histograms, served in the prometheus text format
+
+metrics are always collected (it's a dict update under a lock); they are only served
+if a watcher is started with --metrics-port
+"""
+
+import bisect
+import http.server
+import logging
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+
+try:
+    import pymongo.monitoring
+except ImportError:
+    pymongo = None
+
+registry = list()
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = dict()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.extend(self.render_value(labelvalues, value))
+        return lines
+
+    def render_value(self, labelvalues, value):
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                # per bucket counts (the last one is +Inf), sum
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = self.values[key]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_value(self, labelvalues, value):
+        counts, total = value
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+            cumulative += count
+            labels = format_labels(self.labelnames, labelvalues, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render():
+    lines = list()
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+id_re = re.compile(
+    r"^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|.*\d.*\d.*\d.*\d.*)$",
+    re.IGNORECASE,
+)
+
+
+def normalize_endpoint(url):
+    """
+    the path of url with ids (uuids, numbers, sample names) replaced by {id} and
+    anything under /files/ dropped, so that endpoints can be used as a label
+    """
+    parts = list()
+    for part in urllib.parse.urlparse(url).path.split("/"):
+        if not part:
+            continue
+        parts.append("{id}" if id_re.match(part) else part)
+        if part == "files":
+            break
+    return "/" + "/".join(parts)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, address="127.0.0.1"):
+    """
+    serve /metrics on port from a daemon thread. Does nothing if port isn't set
+    """
+    if not port:
+        return None
+    server = MetricsServer((address, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"serving metrics on http://{address}:{port}/metrics")
+    return server
+
+
+mongo_command_seconds = Histogram(
+    "mongo_command_seconds", "time taken by mongo commands", ["command"]
+)
+
+if pymongo:
+
+    class MongoCommandListener(pymongo.monitoring.CommandListener):
+        """
+        times every mongo command (pass mongo_listeners to MongoClient as event_listeners)
+        """
+
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            mongo_command_seconds.observe(
+                event.duration_micros / 1e6, command=event.command_name
+            )
+
+        def failed(self, event):
+            mongo_command_seconds.observe(
+                event.duration_micros / 1e6, command=event.command_name
+            )
+
+    mongo_listeners = [MongoCommandListener()]
+else:
+    mongo_listeners = list()
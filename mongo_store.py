@@ -0,0 +1,164 @@
+doc = """
+per-item mongo storage for lists of processed things (upload dirs, run uuids, ENA samples)
+
+each processed item is its own document { <scope fields>, "item": <key> } with a unique
+index on the scope fields plus the item, instead of one ever growing array per scope
+"""
+
+import logging
+import time
+
+import pymongo
+
+import tracing
+
+# keep $in queries to a reasonable size
+IN_QUERY_CHUNK_SIZE = 1000
+
+
+def ensure_indexes(collection, scope_fields, lookup_fields=None):
+    """
+    create the unique (scope fields, item) index used for the existence checks
+
+    lookup_fields is a leading subset of scope_fields that items are also looked up by
+    (with find_existing_grouped), which gets its own (lookup fields, item) index
+    """
+    collection.create_index(
+        [(field, pymongo.ASCENDING) for field in scope_fields]
+        + [("item", pymongo.ASCENDING)],
+        unique=True,
+    )
+    if lookup_fields:
+        collection.create_index(
+            [(field, pymongo.ASCENDING) for field in lookup_fields]
+            + [("item", pymongo.ASCENDING)]
+        )
+
+
+@tracing.traced()
+def get_items(collection, scope):
+    """
+    get every item stored for scope
+    """
+    return [doc["item"] for doc in collection.find(scope, {"item": 1, "_id": 0})]
+
+
+@tracing.traced()
+def find_existing(collection, scope, candidates):
+    """
+    return the subset of candidates that are already stored for scope
+    """
+    candidates = list(candidates)
+    found = set()
+    for i in range(0, len(candidates), IN_QUERY_CHUNK_SIZE):
+        chunk = candidates[i : i + IN_QUERY_CHUNK_SIZE]
+        for doc in collection.find(
+            {**scope, "item": {"$in": chunk}}, {"item": 1, "_id": 0}
+        ):
+            found.add(doc["item"])
+    return found
+
+
+@tracing.traced()
+def find_existing_grouped(collection, scope, group_field, candidates):
+    """
+    find_existing for candidates spread over many values of group_field, in one
+    (chunked) query rather than one per group
+
+    candidates are (group value, item) pairs. Returns the set of pairs that are stored
+    """
+    candidates = set(candidates)
+    items = list(set([item for _, item in candidates]))
+    found = set()
+    for i in range(0, len(items), IN_QUERY_CHUNK_SIZE):
+        chunk = items[i : i + IN_QUERY_CHUNK_SIZE]
+        for doc in collection.find(
+            {**scope, "item": {"$in": chunk}}, {group_field: 1, "item": 1, "_id": 0}
+        ):
+            found.add((doc.get(group_field), doc["item"]))
+    return found.intersection(candidates)
+
+
+@tracing.traced()
+def add_items(collection, scope, items, fields=None):
+    """
+    store items for scope. Items that are already stored are left alone
+
+    fields are extra values stored on newly inserted documents
+    """
+    added_time = str(int(time.time()))
+    ops = [
+        pymongo.UpdateOne(
+            {**scope, "item": item},
+            {"$setOnInsert": {"added_time": added_time, **(fields or dict())}},
+            upsert=True,
+        )
+        for item in items
+    ]
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+
+
+@tracing.traced()
+def add_grouped_items(collection, scope, group_field, grouped_items):
+    """
+    add_items for items spread over many values of group_field, in one bulk write
+
+    grouped_items is a dict of group value: [items]
+    """
+    added_time = str(int(time.time()))
+    ops = [
+        pymongo.UpdateOne(
+            {**scope, group_field: group, "item": item},
+            {"$setOnInsert": {"added_time": added_time}},
+            upsert=True,
+        )
+        for group, items in grouped_items.items()
+        for item in items
+    ]
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+
+
+@tracing.traced()
+def remove_items(collection, scope, items):
+    collection.delete_many({**scope, "item": {"$in": list(items)}})
+
+
+def migrate_array_documents(
+    old_collection, new_collection, scope_fields, array_field, query=None
+):
+    """
+    copy the items of the old { <scope fields>, <array_field>: [...] } documents
+    (matching query) into new_collection as one document per item
+
+    the old documents are left in place. Running it again is harmless
+    """
+    ensure_indexes(new_collection, scope_fields)
+    migrated = 0
+    for doc in old_collection.find(query or dict()):
+        scope = {field: doc.get(field) for field in scope_fields}
+        items = doc.get(array_field) or list()
+        add_items(new_collection, scope, items)
+        logging.info(f"migrated {len(items)} items for {scope}")
+        migrated += len(items)
+    return migrated
+
+
+def run_migration(database, name, migrate, force=False):
+    """
+    run migrate() once per database: it's recorded in the database's migrations
+    collection and skipped after that, unless force is set
+
+    returns what migrate() returned (0 if it was skipped)
+    """
+    migrations = database["migrations"]
+    if not force and migrations.find_one({"name": name}):
+        return 0
+    migrated = migrate()
+    migrations.update_one(
+        {"name": name},
+        {"$set": {"migrated": migrated, "time": str(int(time.time()))}},
+        upsert=True,
+    )
+    return migrated
@@ -1,25 +1,8 @@
-import json
-
 import argh
 
-def get_val_from_dict(dict1, path1):
-    try:
-        for p in path1.split("."):
-            dict1 = dict1[p]
-            if type(dict1) == list and dict1:
-                dict1 = dict1[0]
-        val1 = dict1
-        if type(val1) == dict:
-            val1 = list(dict1.keys())[0]
-        if type(val1) == list:
-            val1 = val1[0]
-    except KeyError:
-        return ""
-    return val1
-
-def main(reports_json_file):
-    report_data = json.loads(open(reports_json_file).read())
+import report_csv
 
+def main(reports_json_file, output=None, output_format="csv"):
     species_cols = [
                     "phylogenetics.phylo_group",
                     "phylogenetics.sub_complex",
@@ -50,8 +33,6 @@ def main(reports_json_file):
         "susceptibility.Capreomycin.predict",
         "susceptibility.Capreomycin.called_by"
                    ]
-    out = list()
-
     header = list()
     header.append("sample_name")
     for col in species_cols:
@@ -61,18 +42,12 @@ def main(reports_json_file):
     for col in resistance_cols:
         parts = col.split(".")
         header.append(f'{parts[-2]}.{parts[-1]}')
-        
-    print(",".join(header))   
-    
-    for k, v in report_data.items():
-        row = list()
-        row.append(k)
-        for col in species_cols:
-            row.append(get_val_from_dict(v, col))
-        for col in resistance_cols:
-            row.append(get_val_from_dict(v, col))
-        out.append(",".join(row))
-    return out
+
+    columns = [
+        report_csv.compile_column(col, unwrap_lists=True)
+        for col in species_cols + resistance_cols
+    ]
+    report_csv.export(reports_json_file, header, columns, output, output_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+doc = """
+streaming extraction of columns from a downloaded reports file ({ sample_name: report })
+to csv or parquet, shared by reports2csv and mykrobe2csv
+
+samples are read one at a time with an incremental json decoder (which, like json.load,
+accepts the bare NaNs in sp3 reports and gives floats) and the column paths are parsed
+once up front, so memory use doesn't grow with the number of samples
+"""
+
+import csv
+import json
+import sys
+
+# rows per parquet row group
+PARQUET_BATCH_SIZE = 10000
+# characters read at a time by the json reader
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_reports(reports_json_file):
+    """
+    yield the (sample_name, report) items of a top level json object, decoding one
+    item at a time from a buffer that only holds the item being decoded
+    """
+    decoder = json.JSONDecoder()
+    with open(reports_json_file) as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def skip(chars):
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in chars:
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        def expect(char):
+            nonlocal pos
+            skip(" \t\r\n")
+            if pos >= len(buf) or buf[pos] != char:
+                raise ValueError(f"expected {char!r} at {reports_json_file} offset {pos}")
+            pos += 1
+
+        def decode():
+            nonlocal pos
+            skip(" \t\r\n")
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # a number at the end of the buffer might carry on in the next chunk
+                if not eof and not buf[end:].strip("0123456789+-.eE"):
+                    fill()
+                    continue
+                pos = end
+                return value
+
+        expect("{")
+        while True:
+            skip(" \t\r\n,")
+            if pos < len(buf) and buf[pos] == "}":
+                return
+            sample_name = decode()
+            expect(":")
+            yield sample_name, decode()
+
+
+def compile_column(path, unwrap_lists=False):
+    """
+    parse a dotted column path once and return a function that gets it from a report
+
+    a path part "KEY|a/b" joins a_b of each dict in the list at KEY with "|". With
+    unwrap_lists, a (non-empty) list met along the path is replaced by its first element.
+    A final dict gives its first key, a final list its first element. Missing keys give ""
+    """
+    steps = list()
+    for part in path.split("."):
+        if "|" in part:
+            key, subkeys = part.split("|", 1)
+            steps.append((key, subkeys.split("/")))
+        else:
+            steps.append((part, None))
+
+    def get(report):
+        value = report
+        try:
+            for key, subkeys in steps:
+                value = value[key]
+                if subkeys is not None:
+                    value = "|".join(
+                        "_".join(d[k] for k in subkeys if k in d) for d in value
+                    )
+                elif unwrap_lists and type(value) == list and value:
+                    value = value[0]
+            if type(value) == dict:
+                value = list(value.keys())[0]
+            if type(value) == list:
+                value = value[0]
+        except KeyError:
+            return ""
+        return value
+
+    return get
+
+
+def iter_rows(reports_json_file, columns):
+    for sample_name, report in iter_reports(reports_json_file):
+        yield [sample_name] + [get(report) for get in columns]
+
+
+def write_csv(rows, header, output=None):
+    f = open(output, "w", newline="") if output else sys.stdout
+    try:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+    finally:
+        if output:
+            f.close()
+
+
+def write_parquet(rows, header, output):
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([(name, pyarrow.string()) for name in header])
+
+    def to_table(batch):
+        return pyarrow.Table.from_arrays(
+            [pyarrow.array(column, pyarrow.string()) for column in zip(*batch)],
+            schema=schema,
+        )
+
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        batch = list()
+        for row in rows:
+            batch.append(["" if v is None else str(v) for v in row])
+            if len(batch) >= PARQUET_BATCH_SIZE:
+                writer.write_table(to_table(batch))
+                batch = list()
+        if batch:
+            writer.write_table(to_table(batch))
+
+
+def export(reports_json_file, header, columns, output=None, output_format="csv"):
+    """
+    write one row per sample (sample name, then columns) to output (stdout for csv if
+    not given) as csv or parquet (needs pyarrow)
+    """
+    rows = iter_rows(reports_json_file, columns)
+    if output_format == "csv":
+        write_csv(rows, header, output)
+    elif output_format == "parquet":
+        if not output:
+            raise ValueError("parquet output needs --output")
+        write_parquet(rows, header, output)
+    else:
+        raise ValueError(f"unknown output format {output_format}")
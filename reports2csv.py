@@ -1,48 +1,8 @@
-import json
-
 import argh
 
-def get_list_value(dict1,path1):
-    '''
-    path1 = LEV|gene_name, mutation_name
-    result = gyrA_E21Q|gyrA_S95T
-    '''
-    key = path1.split('|')[0]
-    keys = path1.split('|')[1].split('/')
-
-    list1 = dict1[key]
-
-    val1 = dict()
-    val1_list = []
-    for dic1 in list1:
-        val_list = []
-        for k in keys:
-            if k in dic1.keys():
-                val_list.append(dic1[k])
-        val_list_string = '_'.join(val_list)
-        val1_list.append(val_list_string)
-    val1 = '|'.join(val1_list)
-    return val1
-
-def get_val_from_dict(dict1, path1):
-    try:
-        for p in path1.split("."):
-            if '|' in p:
-                dict1 = get_list_value(dict1,p)
-            else:
-                dict1 = dict1[p]
-        val1 = dict1
-        if type(val1) == dict:
-            val1 = list(dict1.keys())[0]
-        if type(val1) == list:
-            val1 = val1[0]
-    except KeyError:
-        return ""
-    return val1
-
-def main(reports_json_file):
-    report_data = json.loads(open(reports_json_file).read())
+import report_csv
 
+def main(reports_json_file, output=None, output_format="csv"):
     piezo_cols = ["resistance.data.prediction_ex.INH",
                "resistance.data.INH|gene_name/mutation_name",
                "resistance.data.prediction_ex.RIF",
@@ -94,8 +54,6 @@ def main(reports_json_file):
                "mykrobe_speciation.data.susceptibility.Capreomycin.called_by"
                ]
 
-    out = list()
-
     header = list()
     header.append("sample_name")
     for col in piezo_cols:
@@ -107,17 +65,11 @@ def main(reports_json_file):
     for col in mykrobe_cols:
         parts = col.split(".")
         header.append(f'{parts[-2]} | {parts[-1]}')
-    print(",".join(header))
 
     all_cols = piezo_cols + mykrobe_cols
 
-    for k, v in report_data.items():
-        row = list()
-        row.append(k)
-        for col in all_cols:
-            row.append(get_val_from_dict(v, col))
-        out.append(",".join(row))
-    return out
+    columns = [report_csv.compile_column(col) for col in all_cols]
+    report_csv.export(reports_json_file, header, columns, output, output_format)
 
 
 if __name__ == "__main__":
@@ -8,17 +8,20 @@ import logging
 import os
 import time
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from pathlib import Path
 
 import argh
 import gridfs
 import pymongo
-import requests
 
 import catsgo
 import utils
 import db
+import metrics
+import mongo_store
+import tracing
 import sentry_sdk
 
 config = utils.load_config("config.json")
@@ -40,12 +43,37 @@ sentry_sdk.init(
         before_send=before_send
 )
 
-myclient = pymongo.MongoClient("mongodb://localhost:27017/")
+myclient = pymongo.MongoClient(
+    "mongodb://localhost:27017/", event_listeners=metrics.mongo_listeners
+)
 mydb = myclient["dir_watcher"]
 metadata = mydb["metadata"]
 runlist = mydb["runlist"]
+submitted_runs = mydb["submitted_runs"]
+sample_submissions = mydb["sample_submissions"]
+
+mongo_store.ensure_indexes(submitted_runs, ["pipeline_name"])
+sample_submissions.create_index(
+    [("run_uuid", pymongo.ASCENDING), ("sp3_sample_name", pymongo.ASCENDING)],
+    unique=True,
+)
 
 
+poll_seconds = metrics.Histogram(
+    "run_watcher_poll_seconds", "time taken to find and submit newly finished runs", ["flow_name"]
+)
+runs_pending = metrics.Gauge(
+    "run_watcher_runs_pending", "newly finished runs found by the last poll", ["flow_name"]
+)
+runs_submitted = metrics.Counter(
+    "run_watcher_runs_total", "finished runs submitted to apex", ["flow_name"]
+)
+sample_submissions_total = metrics.Counter(
+    "run_watcher_sample_submissions_total",
+    "samples sent to apex by result (submitted, error_submitted, rejected, failed, gave_up)",
+    ["status"],
+)
+
 logging.basicConfig(
     level=logging.DEBUG,
     format="%(asctime)s.%(msecs)03d %(levelname)s %(module)s - %(funcName)s: %(message)s",
@@ -54,19 +82,38 @@ logging.basicConfig(
 
 
 def get_submitted_runlist(pipeline_name):
-    ret = runlist.find_one({"pipeline_name": pipeline_name}, {"finished_uuids": 1})
-    if not ret:
-        return list()
-    else:
-        return list(ret.get("finished_uuids", list()))
+    return mongo_store.get_items(submitted_runs, {"pipeline_name": pipeline_name})
+
+
+def get_submitted_runs(pipeline_name, run_uuids):
+    """
+    get the subset of run_uuids that have already been submitted
+    """
+    return mongo_store.find_existing(
+        submitted_runs, {"pipeline_name": pipeline_name}, run_uuids
+    )
 
 
 def add_to_submitted_runlist(pipeline_name, new_run_uuid):
-    runlist.update_one(
-        {"pipeline_name": pipeline_name},
-        {"$push": {"finished_uuids": new_run_uuid}},
-        upsert=True,
+    mongo_store.add_items(submitted_runs, {"pipeline_name": pipeline_name}, [new_run_uuid])
+
+
+def migrate_runlist(force=False):
+    """
+    copy the old per-pipeline "finished_uuids" arrays into the submitted_runs collection
+
+    watch runs this when it starts, so that old runs aren't sent to apex again. It is
+    only done once per database unless force is set
+    """
+    n = mongo_store.run_migration(
+        mydb,
+        "runlist",
+        lambda: mongo_store.migrate_array_documents(
+            runlist, submitted_runs, ["pipeline_name"], "finished_uuids"
+        ),
+        force,
     )
+    logging.info(f"migrated {n} runs")
 
 
 def save_sample_data(new_run_uuid, sp3_sample_name, sample_data):
@@ -77,6 +124,72 @@ def save_sample_data(new_run_uuid, sp3_sample_name, sample_data):
     )
 
 
+# outcomes that won't change by sending the sample again: sent (results or an error),
+# rejected by apex (4xx) or failed sample_submission_max_attempts times
+final_statuses = ["submitted", "error_submitted", "rejected", "gave_up"]
+sample_submission_max_attempts = int(config.get("sample_submission_max_attempts", 10))
+sample_submission_retry_backoff = int(config.get("sample_submission_retry_backoff", 60))
+sample_submission_retry_max_backoff = int(
+    config.get("sample_submission_retry_max_backoff", 60 * 60)
+)
+
+
+def get_sample_states(new_run_uuid):
+    """
+    get the sp3 sample names of a run that have a final outcome, and the ones that
+    failed recently and can't be sent again yet
+    """
+    final, waiting = set(), set()
+    for d in sample_submissions.find(
+        {"run_uuid": new_run_uuid},
+        {"sp3_sample_name": 1, "status": 1, "next_retry_time": 1},
+    ):
+        if d.get("status") in final_statuses:
+            final.add(d["sp3_sample_name"])
+        elif d.get("next_retry_time", 0) > time.time():
+            waiting.add(d["sp3_sample_name"])
+    return final, waiting
+
+
+def record_sample_submission(
+    new_run_uuid, sp3_sample_name, apex_database_sample_name, status, response_text
+):
+    """
+    record an attempt at sending a sample to apex. A failed sample can be sent again
+    after a backoff that doubles with every attempt, and is given up on after
+    sample_submission_max_attempts. Returns the recorded status
+    """
+    query = {"run_uuid": new_run_uuid, "sp3_sample_name": sp3_sample_name}
+    doc = sample_submissions.find_one_and_update(
+        query,
+        {
+            "$set": {
+                "apex_database_sample_name": apex_database_sample_name,
+                "status": status,
+                "response": response_text,
+                "time": str(int(time.time())),
+            },
+            "$inc": {"attempts": 1},
+        },
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    if status != "failed":
+        return status
+    attempts = doc["attempts"]
+    if attempts >= sample_submission_max_attempts:
+        logging.error(f"giving up on {sp3_sample_name} of {new_run_uuid} after {attempts} attempts")
+        status = "gave_up"
+        sample_submissions.update_one(query, {"$set": {"status": status}})
+        return status
+    delay = min(
+        sample_submission_retry_max_backoff,
+        sample_submission_retry_backoff * 2 ** (attempts - 1),
+    )
+    sample_submissions.update_one(query, {"$set": {"next_retry_time": time.time() + delay}})
+    return status
+
+
 def get_data_for_run(new_run_uuid):
     data = metadata.find_one({"run_uuid": new_run_uuid}, {"_id": 0})
     return data
@@ -263,7 +376,15 @@ def submit_sample_data_error(
         # just in case
         error_str = str(error_str)
 
-    data = {
+    sample_data_response = put_sample_data(
+        apex_database_sample_name, make_error_operations(error_str), config, apex_token
+    )
+    logging.info(f"POSTing error to {config['host']}/samples/{apex_database_sample_name}")
+    return sample_data_response.text
+
+
+def make_error_operations(error_str):
+    return {
         "sample": {
             "operations": [
                 {
@@ -276,57 +397,125 @@ def submit_sample_data_error(
         }
     }
 
-    sample_data_response = requests.put(
-        f"{config['host']}/samples/{apex_database_sample_name}",
-        headers={"Authorization": f"Bearer {apex_token}"},
-        json=data,
+
+def make_analysis_operations(data):
+    return {
+        "sample": {"operations": [{"op": "add", "path": "analysis", "value": [data]}]}
+    }
+
+
+def put_sample_data(apex_database_sample_name, data, config, apex_token):
+    return db.apex.put(
+        f"{config['host']}/samples/{apex_database_sample_name}", apex_token, json=data
     )
-    logging.info(f"POSTing error to {config['host']}/samples/{apex_database_sample_name}")
-    return sample_data_response.text
 
 
 def submit_sample_data(apex_database_sample_name, data, config, apex_token):
-    data = {
-        "sample": {"operations": [{"op": "add", "path": "analysis", "value": [data]}]}
-    }
-    sample_data_response = requests.put(
-        f"{config['host']}/samples/{apex_database_sample_name}",
-        headers={"Authorization": f"Bearer {apex_token}"},
-        json=data,
+    sample_data_response = put_sample_data(
+        apex_database_sample_name, make_analysis_operations(data), config, apex_token
     )
     logging.info(f"POSTing to {config['host']}/samples/{apex_database_sample_name}")
     return sample_data_response.text
 
 
-def send_output_data_to_api(new_run_uuid, config, apex_token):
-    sample_map = get_sample_map_for_run(new_run_uuid)
-    if not sample_map:
-        return
-    sample_map = json.loads(sample_map)
-
-    for sp3_sample_name, apex_database_sample_name in sample_map.items():
-        logging.info(
-            f"processing sample {sp3_sample_name} (oracle id: {apex_database_sample_name})"
-        )
+def send_sample_data_to_api(
+    new_run_uuid, sp3_sample_name, apex_database_sample_name, config, apex_token
+):
+    """
+    send the results (or an error if there aren't any) of one sample to apex and record the outcome
+    """
+    logging.info(
+        f"processing sample {sp3_sample_name} (oracle id: {apex_database_sample_name})"
+    )
+    try:
         sample_data = make_sample_data(new_run_uuid, sp3_sample_name)
 
         if sample_data:
-            r = submit_sample_data(
-                apex_database_sample_name, sample_data, config, apex_token
+            status = "submitted"
+            r = put_sample_data(
+                apex_database_sample_name,
+                make_analysis_operations(sample_data),
+                config,
+                apex_token,
             )
-            logging.info(f"received {r}")
         else:
             logging.warning(
                 f"Couldn't get sample data for {sp3_sample_name} (oracle id: {apex_database_sample_name})"
             )
-            submit_sample_data_error(
-                "Couldn't get sample data",
-                apex_database_sample_name=apex_database_sample_name,
+            status = "error_submitted"
+            r = put_sample_data(
+                apex_database_sample_name,
+                make_error_operations("Couldn't get sample data"),
+                config,
+                apex_token,
             )
+        logging.info(f"received {r.text}")
+        if not r.ok:
+            logging.error(
+                f"apex returned {r.status_code} for {sp3_sample_name} (oracle id: {apex_database_sample_name})"
+            )
+            # sending the same data again won't fix a 4xx, but might a 5xx or a 429
+            if r.status_code == 429 or r.status_code >= 500:
+                status = "failed"
+            else:
+                status = "rejected"
+        response_text = r.text
+    except Exception as e:
+        logging.error(f"failed to send {sp3_sample_name} to apex: {str(e)}")
+        status = "failed"
+        response_text = str(e)
 
+    status = record_sample_submission(
+        new_run_uuid, sp3_sample_name, apex_database_sample_name, status, response_text
+    )
+    sample_submissions_total.inc(status=status)
+    return status
 
+
+def send_output_data_to_api(new_run_uuid, config, apex_token, workers=8):
+    """
+    send the results of every sample of a run to apex, workers samples at a time
+
+    samples that already have a final outcome (e.g. from before run_watcher was
+    restarted) are skipped, as are failed samples that are backing off. Returns True
+    once every sample has a final outcome, False if the run needs trying again
+    """
+    sample_map = get_sample_map_for_run(new_run_uuid)
+    if not sample_map:
+        return True
+    sample_map = json.loads(sample_map)
+
+    final, waiting = get_sample_states(new_run_uuid)
+    if final or waiting:
+        logging.info(
+            f"{len(final)} samples of {new_run_uuid} already done, {len(waiting)} waiting to be retried"
+        )
+    samples = [
+        (sp3_sample_name, apex_database_sample_name)
+        for sp3_sample_name, apex_database_sample_name in sample_map.items()
+        if sp3_sample_name not in final and sp3_sample_name not in waiting
+    ]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(
+            executor.map(
+                tracing.propagate(
+                    lambda sample: send_sample_data_to_api(
+                        new_run_uuid, sample[0], sample[1], config, apex_token
+                    )
+                ),
+                samples,
+            )
+        )
+    failed = statuses.count("failed")
+    if failed:
+        logging.error(f"{failed} of {len(samples)} samples of {new_run_uuid} failed")
+    return not failed and not waiting
+
+
+@tracing.traced()
 def process_run(new_run_uuid, config, apex_token):
-    send_output_data_to_api(new_run_uuid, config, apex_token)
+    return send_output_data_to_api(new_run_uuid, config, apex_token)
 
 
 def get_finished_sp3_runs(pipeline_name):
@@ -334,37 +523,58 @@ def get_finished_sp3_runs(pipeline_name):
     This will return all the runs that have finished
     with a status of OK or ERR
     """
-    ok_lst = catsgo.get_all_runs2(pipeline_name) \
-        .get("status_to_run_uuid", dict()).get("OK", list())
-    err_lst = catsgo.get_all_runs2(pipeline_name) \
-        .get("status_to_run_uuid", dict()).get("ERR", list())
-    return ok_lst + err_lst
+    status_to_run_uuid = catsgo.get_all_runs2(pipeline_name).get(
+        "status_to_run_uuid", dict()
+    )
+    return status_to_run_uuid.get("OK", list()) + status_to_run_uuid.get("ERR", list())
+
+
+def get_new_finished_sp3_runs(pipeline_name, seen_runs):
+    """
+    Return the finished runs that are not in seen_runs and add them to it
 
+    seen_runs is the local high-water mark of every finished run uuid that has
+    already been looked at, so only the delta since the last poll is checked
+    against the runs that have already been submitted
+    """
+    new_runs = set(get_finished_sp3_runs(pipeline_name)).difference(seen_runs)
+    seen_runs.update(new_runs)
+    return new_runs.difference(get_submitted_runs(pipeline_name, new_runs))
 
-def watch(flow_name="oxforduni-gpas-sars-cov2-illumina"):
-    apex_token = None
-    apex_token_time = 0
+
+def watch(flow_name="oxforduni-gpas-sars-cov2-illumina", metrics_port=None):
+    """
+    metrics_port: serve prometheus metrics on http://127.0.0.1:<metrics_port>/metrics
+    """
     config = utils.load_oracle_config("config.json")
+    metrics.serve(metrics_port)
+    migrate_runlist()
+
+    # only runs that finished since the previous poll are considered
+    seen_runs = set()
 
     while True:
-        # get a new token every 5 hours (& startup)
-        time_now = int(time.time())
-        apex_token_age = time_now - apex_token_time
-        if apex_token_age > 5 * 60 * 60:
-            logging.info(f"Acquiring new token (token age: {apex_token_age}s)")
+        with poll_seconds.time(flow_name=flow_name), tracing.span(
+            "run_watcher.poll", flow_name=flow_name
+        ):
+            # cached by db until shortly before it expires
             apex_token = db.get_apex_token()
-            apex_token_time = time_now
-
-        # new runs to submit are sp3 runs that have finished with status of OK or ERR
-        # minus runs that have been marked as already submitted
-        finished_sp3_runs = set(get_finished_sp3_runs(flow_name))
-        submitted_runs = set(get_submitted_runlist(flow_name))
-        new_runs_to_submit = finished_sp3_runs.difference(submitted_runs)
 
-        for new_run_uuid in new_runs_to_submit:
-            logging.info(f"new run: {new_run_uuid}")
-            process_run(new_run_uuid, config, apex_token)
-            add_to_submitted_runlist(flow_name, new_run_uuid)
+            # new runs to submit are sp3 runs that have finished with status of OK or ERR
+            # minus runs that have already been seen or submitted
+            new_runs_to_submit = get_new_finished_sp3_runs(flow_name, seen_runs)
+            runs_pending.set(len(new_runs_to_submit), flow_name=flow_name)
+
+            for new_run_uuid in new_runs_to_submit:
+                logging.info(f"new run: {new_run_uuid}")
+                if process_run(new_run_uuid, config, apex_token):
+                    add_to_submitted_runlist(flow_name, new_run_uuid)
+                    runs_submitted.inc(flow_name=flow_name)
+                else:
+                    # looked at again next poll, failed samples are sent again once
+                    # their backoff is over
+                    logging.warning(f"{new_run_uuid} has samples to retry")
+                    seen_runs.discard(new_run_uuid)
 
         logging.info("sleeping for 60")
         time.sleep(60)
@@ -379,5 +589,6 @@ if __name__ == "__main__":
             get_sample_map_for_run,
             submit_sample_data,
             submit_sample_data_error,
+            migrate_runlist,
         ]
     )
@@ -0,0 +1,102 @@
+doc = """
+throttles how fast new pipeline runs are started on sp3
+"""
+
+import logging
+import threading
+import time
+
+import catsgo
+
+
+class SubmissionScheduler:
+    """
+    decides whether another pipeline run can be started right now
+
+    starts are limited by a token bucket (starts_per_minute, refilling up to burst)
+    and by the number of runs that sp3 reports as running for flow_names (max_in_flight,
+    0 for no limit)
+    """
+
+    def __init__(
+        self,
+        flow_names,
+        max_in_flight=20,
+        starts_per_minute=1.0,
+        burst=1,
+        running_check_interval=60,
+    ):
+        self.flow_names = list(flow_names)
+        self.max_in_flight = int(max_in_flight)
+        self.starts_per_minute = float(starts_per_minute)
+        self.burst = max(1, int(burst))
+        self.running_check_interval = running_check_interval
+
+        self.lock = threading.Lock()
+        self.tokens = float(self.burst)
+        self.tokens_time = time.time()
+        self.running = 0
+        self.running_time = 0
+        # runs started (or being started) since sp3 was last asked
+        self.in_flight = 0
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.tokens_time) * self.starts_per_minute / 60,
+        )
+        self.tokens_time = now
+
+    def count_running(self):
+        """
+        count the runs sp3 lists as running ("-" status, as in catsgo.check_run)
+        """
+        running = 0
+        for flow_name in self.flow_names:
+            try:
+                runs = catsgo.get_all_runs2(flow_name).get("status_to_run_uuid", dict())
+            except Exception as e:
+                logging.warning(f"couldn't get running runs for {flow_name}: {e}")
+                return None
+            running += len(runs.get("-", list()))
+        return running
+
+    def update_running(self):
+        if not self.max_in_flight:
+            return
+        if time.time() - self.running_time < self.running_check_interval:
+            return
+        running = self.count_running()
+        if running is not None:
+            self.running = running
+            self.in_flight = 0
+            self.running_time = time.time()
+
+    def acquire(self):
+        """
+        take a start slot. Returns False if no more runs should be started now
+        """
+        with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                return False
+            self.update_running()
+            if self.max_in_flight and self.running + self.in_flight >= self.max_in_flight:
+                logging.info(
+                    f"{self.running + self.in_flight} runs in flight (max {self.max_in_flight})"
+                )
+                return False
+            self.tokens -= 1
+            self.in_flight += 1
+            return True
+
+    def release(self, started):
+        """
+        give back a slot taken with acquire if the run wasn't started after all
+        """
+        if started:
+            return
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+            self.in_flight = max(0, self.in_flight - 1)
@@ -0,0 +1,183 @@
+doc = """
+persistent submission attempts and dead letters for dir_watcher uploads
+
+every attempt at submitting an upload is counted in mongo with its last error and the
+time it can next be tried (exponential backoff), so retries survive restarts. Uploads
+that fail max_submission_attempts times (or fail in a way that retrying won't fix) are
+moved to the dead_letters collection with the reason, until they are requeued
+"""
+
+import logging
+import time
+from pathlib import Path
+
+import pymongo
+
+import mongo_store
+
+
+class SubmissionFailed(Exception):
+    """
+    a submission attempt failed for a known reason. permanent failures are dead
+    lettered straight away instead of being retried
+    """
+
+    def __init__(self, reason, permanent=False):
+        super().__init__(reason)
+        self.permanent = permanent
+
+
+class SubmissionTracker:
+    """
+    submission attempts and dead letters stored in the dir_watcher mongo database
+
+    both collections have one document per (watch_dir, upload dir), with the upload dir
+    as the mongo_store "item"
+    """
+
+    def __init__(self, mydb, backoff=300, max_backoff=6 * 60 * 60):
+        self.attempts = mydb["submission_attempts"]
+        self.dead_letters = mydb["dead_letters"]
+        self.processed_dirs = mydb["processed_dirs"]
+        self.ignore_list = mydb["ignore_list"]
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        mongo_store.ensure_indexes(self.attempts, ["watch_dir"])
+        mongo_store.ensure_indexes(self.dead_letters, ["watch_dir"])
+
+    def get_dead_lettered(self, watch_dir, candidate_dirs):
+        return mongo_store.find_existing(
+            self.dead_letters, {"watch_dir": watch_dir}, candidate_dirs
+        )
+
+    def get_backing_off(self, watch_dir, candidate_dirs):
+        """
+        the subset of candidate_dirs that failed recently and can't be tried again yet
+        """
+        candidate_dirs = list(candidate_dirs)
+        waiting = set()
+        for i in range(0, len(candidate_dirs), mongo_store.IN_QUERY_CHUNK_SIZE):
+            chunk = candidate_dirs[i : i + mongo_store.IN_QUERY_CHUNK_SIZE]
+            for doc in self.attempts.find(
+                {
+                    "watch_dir": watch_dir,
+                    "item": {"$in": chunk},
+                    "next_eligible_time": {"$gt": time.time()},
+                },
+                {"item": 1, "_id": 0},
+            ):
+                waiting.add(doc["item"])
+        return waiting
+
+    def is_eligible(self, watch_dir, new_dir):
+        if self.get_dead_lettered(watch_dir, [new_dir]):
+            return False
+        return not self.get_backing_off(watch_dir, [new_dir])
+
+    def start_attempt(self, watch_dir, new_dir):
+        """
+        count a new attempt. Returns the attempt number
+        """
+        doc = self.attempts.find_one_and_update(
+            {"watch_dir": watch_dir, "item": new_dir},
+            {"$inc": {"attempts": 1}, "$set": {"last_attempt_time": time.time()}},
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        return doc["attempts"]
+
+    def succeeded(self, watch_dir, new_dir):
+        self.attempts.delete_one({"watch_dir": watch_dir, "item": new_dir})
+
+    def failed(self, watch_dir, new_dir, reason, max_submission_attempts, permanent=False):
+        """
+        record a failed attempt. The upload can be tried again after a backoff that
+        doubles with every attempt, or is dead lettered once it has used up its attempts.
+        Returns True if it was dead lettered
+        """
+        doc = self.attempts.find_one({"watch_dir": watch_dir, "item": new_dir}) or dict()
+        attempts = doc.get("attempts", 1)
+        if permanent or attempts >= int(max_submission_attempts):
+            self.dead_letter(watch_dir, new_dir, reason, attempts)
+            return True
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        self.attempts.update_one(
+            {"watch_dir": watch_dir, "item": new_dir},
+            {"$set": {"last_error": reason, "next_eligible_time": time.time() + delay}},
+            upsert=True,
+        )
+        logging.info(f"{new_dir}: attempt {attempts} failed ({reason}), retrying in {delay}s")
+        return False
+
+    def dead_letter(self, watch_dir, new_dir, reason, attempts=0):
+        logging.warning(f"bad submission: {new_dir}: {reason}")
+        self.dead_letters.update_one(
+            {"watch_dir": watch_dir, "item": new_dir},
+            {
+                "$set": {
+                    "reason": reason,
+                    "attempts": attempts,
+                    "dead_lettered_time": time.time(),
+                }
+            },
+            upsert=True,
+        )
+        self.attempts.delete_one({"watch_dir": watch_dir, "item": new_dir})
+
+    def list_dead_letters(self, watch_dir=None):
+        query = {"watch_dir": watch_dir} if watch_dir else dict()
+        return list(
+            self.dead_letters.find(query, {"_id": 0}).sort("dead_lettered_time", pymongo.ASCENDING)
+        )
+
+    def show(self, watch_dir, new_dir):
+        """
+        the dead letter, attempts and processed_dirs documents of an upload
+        """
+        query = {"watch_dir": watch_dir, "item": new_dir}
+        return {
+            "dead_letter": self.dead_letters.find_one(query, {"_id": 0}),
+            "attempts": self.attempts.find_one(query, {"_id": 0}),
+            "processed": self.processed_dirs.find_one(query, {"_id": 0}),
+        }
+
+    def requeue(self, watch_dir, new_dir, delete_sp3data=False):
+        """
+        make dir_watcher submit an upload again: forget its attempts, dead letter, old
+        ignore list entry and processed_dirs entry
+
+        with delete_sp3data, the upload's sp3data.csv is deleted too, so its metadata
+        is fetched from the ORDS DB again
+        """
+        query = {"watch_dir": watch_dir, "item": new_dir}
+        self.dead_letters.delete_one(query)
+        self.attempts.delete_one(query)
+        mongo_store.remove_items(self.processed_dirs, {"watch_dir": watch_dir}, [new_dir])
+        self.ignore_list.update_one(
+            {"watch_dir": watch_dir}, {"$pull": {"ignore_list": new_dir}}
+        )
+        sp3data_csv = Path(watch_dir) / new_dir / "sp3data.csv"
+        if delete_sp3data and sp3data_csv.exists():
+            logging.info(f"deleting {sp3data_csv}")
+            sp3data_csv.unlink()
+
+    def migrate_ignore_list(self):
+        """
+        one-off copy of the old per-watch_dir ignore lists into dead_letters
+        """
+        migrated = 0
+        for doc in self.ignore_list.find({"watch_dir": {"$exists": True}}):
+            for new_dir in doc.get("ignore_list") or list():
+                self.dead_letters.update_one(
+                    {"watch_dir": doc["watch_dir"], "item": new_dir},
+                    {
+                        "$setOnInsert": {
+                            "reason": "in the old ignore list",
+                            "attempts": 0,
+                            "dead_lettered_time": time.time(),
+                        }
+                    },
+                    upsert=True,
+                )
+                migrated += 1
+        return migrated
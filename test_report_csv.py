@@ -0,0 +1,113 @@
+# Test report_csv.py, reports2csv.py, mykrobe2csv.py and verify_reports.py on the reports in data/
+# The expected csv files in data/ are the output of the reports2csv.py and mykrobe2csv.py
+# that printed ",".join(row) for every sample
+# Run all tests: python3 test_report_csv.py
+
+import unittest
+import csv
+import json
+import pathlib
+import tempfile
+
+import mykrobe2csv
+import report_csv
+import reports2csv
+import verify_reports
+
+data_dir = pathlib.Path(__file__).parent / "data"
+
+
+def read_rows(csv_file):
+    with open(csv_file, newline="") as f:
+        return list(csv.reader(f))
+
+
+def read_lines(csv_file):
+    with open(csv_file) as f:
+        return f.read().splitlines()
+
+
+class TestReportCsv(unittest.TestCase):
+    def check_main(self, main, reports_json_file, expected_csv_file):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = pathlib.Path(tmp) / "out.csv"
+            main(str(data_dir / reports_json_file), output=str(output))
+            # csv.writer quotes fields that the old output didn't, so compare the
+            # parsed rows joined the old way
+            rows = [",".join(row) for row in read_rows(output)]
+        self.assertEqual(rows, read_lines(data_dir / expected_csv_file))
+
+    def test_reports2csv(self):
+        self.check_main(reports2csv.main, "sp3reports.json", "sp3reports.reports2csv.csv")
+
+    def test_mykrobe2csv(self):
+        self.check_main(mykrobe2csv.main, "mykrobe_output.json", "mykrobe_output.mykrobe2csv.csv")
+
+    def test_mykrobe2csv_sp3reports(self):
+        self.check_main(mykrobe2csv.main, "sp3reports.json", "sp3reports.mykrobe2csv.csv")
+
+    def test_iter_reports(self):
+        # sp3reports.json has bare NaNs, which json.load accepts
+        for reports_json_file in sorted(data_dir.glob("*.json")):
+            with open(reports_json_file) as f:
+                expected = json.dumps(list(json.load(f).items()))
+            for chunk_size in [7, 4096, 1024 * 1024]:
+                report_csv.READ_CHUNK_SIZE = chunk_size
+                try:
+                    got = json.dumps(list(report_csv.iter_reports(reports_json_file)))
+                finally:
+                    report_csv.READ_CHUNK_SIZE = 1024 * 1024
+                self.assertEqual(got, expected, f"{reports_json_file} chunk size {chunk_size}")
+
+
+class TestVerifyReports(unittest.TestCase):
+    def make_truth(self, sp3_report):
+        data = sp3_report["mykrobe_speciation"]["data"]
+        resistance = sp3_report["resistance"]["data"]
+        return {
+            "mykrobe_speciation": {
+                "data": {
+                    "species": list(data["species"].keys())[0],
+                    "lineages": data["lineages"],
+                }
+            },
+            "resistance": {
+                "data": {
+                    "prediction_ex": resistance["prediction_ex"],
+                    "effects": [
+                        {k: v for k, v in effect.items() if k != "source"}
+                        for effect in resistance["effects"]
+                    ],
+                }
+            },
+        }
+
+    def test_verify_all(self):
+        reports_file = data_dir / "sp3reports.json"
+        with open(reports_file) as f:
+            reports = json.load(f)
+        sample_names = list(reports.keys())
+        with tempfile.TemporaryDirectory() as tmp:
+            truth_dir = pathlib.Path(tmp)
+            for sample_name in sample_names:
+                truth = self.make_truth(reports[sample_name])
+                if sample_name == sample_names[-1]:
+                    truth["mykrobe_speciation"]["data"]["lineages"] = ["lineage0"]
+                with open(truth_dir / f"{sample_name}.json", "w") as f:
+                    json.dump(truth, f)
+
+            sp3_samples, results = verify_reports.verify_all(
+                reports_file, truth_dir, set(sample_names), workers=2
+            )
+
+        self.assertEqual(sp3_samples, sample_names)
+        self.assertEqual(set(results.keys()), set(sample_names))
+        for sample_name in sample_names[:-1]:
+            self.assertEqual(results[sample_name], [])
+        self.assertEqual(
+            [m["field"] for m in results[sample_names[-1]]], ["lineages"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
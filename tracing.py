@@ -0,0 +1,265 @@
+doc = """
+named spans around the slow parts (sp3/apex requests, filesystem scans, md5 hashing,
+mongo calls), sent to sentry, opentelemetry or a json-lines file
+
+config.json keys:
+    tracing_backend: "sentry", "opentelemetry", "jsonl" or "none" (the default)
+    tracing_file: the file for the jsonl backend (default trace.jsonl)
+    tracing_sample_rates: { span name or prefix: rate }, e.g.
+        {"dir_watcher.poll": 1.0, "apex": 0.1, "default": 0.01}
+
+a span is recorded if its parent span is recorded, otherwise with the sample rate of
+its name, the part of its name before the first ".", or "default" (1.0 if not set).
+With no backend, span() does next to nothing
+"""
+
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import utils
+
+try:
+    config = utils.load_config("config.json")
+except (OSError, ValueError):
+    config = dict()
+
+local = threading.local()
+
+
+class NoopSpan:
+    recorded = False
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+noop_span = NoopSpan()
+
+
+class Span:
+    """
+    a recorded span. Used as a context manager, it is the current span of its thread
+    while it's open
+    """
+
+    recorded = True
+
+    def __init__(self, backend, name, attrs, parent):
+        self.backend = backend
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.handle = None
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_perf = time.perf_counter()
+        self.handle = self.backend.start(self)
+        self.previous = getattr(local, "span", None)
+        local.span = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        local.span = self.previous
+        self.duration = time.perf_counter() - self.start_perf
+        try:
+            self.backend.finish(self, exc)
+        except Exception as e:
+            logging.warning(f"couldn't record span {self.name}: {e}")
+        return False
+
+
+class JsonlBackend:
+    """
+    appends one json line per finished span to path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def start(self, span):
+        return None
+
+    def finish(self, span, error):
+        line = json.dumps(
+            {
+                "name": span.name,
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent.span_id if span.parent else None,
+                "start": span.start,
+                "duration": span.duration,
+                "attrs": span.attrs,
+                "error": repr(error) if error else None,
+                "pid": os.getpid(),
+                "thread": threading.current_thread().name,
+            },
+            default=str,
+        )
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class SentryBackend:
+    """
+    root spans are sentry transactions (always sent, the sampling is done here),
+    the others are child spans of their parent's transaction/span
+    """
+
+    def __init__(self):
+        import sentry_sdk
+
+        self.sentry_sdk = sentry_sdk
+
+    def start(self, span):
+        if span.parent and span.parent.handle is not None:
+            s = span.parent.handle.start_child(op=span.name, description=span.name)
+        else:
+            s = self.sentry_sdk.start_transaction(op=span.name, name=span.name, sampled=True)
+        return s
+
+    def finish(self, span, error):
+        for key, value in span.attrs.items():
+            span.handle.set_data(key, value)
+        if error:
+            span.handle.set_status("internal_error")
+        span.handle.finish()
+
+
+class OpenTelemetryBackend:
+    """
+    spans of the globally configured opentelemetry tracer provider (and exporter),
+    e.g. as set up by opentelemetry-instrument
+    """
+
+    def __init__(self):
+        from opentelemetry import trace
+
+        self.trace = trace
+        self.tracer = trace.get_tracer("catsgo")
+
+    def start(self, span):
+        context = None
+        if span.parent and span.parent.handle is not None:
+            context = self.trace.set_span_in_context(span.parent.handle)
+        return self.tracer.start_span(span.name, context=context)
+
+    def finish(self, span, error):
+        for key, value in span.attrs.items():
+            if value is not None:
+                span.handle.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        if error:
+            span.handle.record_exception(error)
+            span.handle.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        span.handle.end()
+
+
+def make_backend(name):
+    name = (name or "none").lower()
+    if name == "none":
+        return None
+    try:
+        if name == "jsonl":
+            return JsonlBackend(config.get("tracing_file", "trace.jsonl"))
+        if name == "sentry":
+            return SentryBackend()
+        if name == "opentelemetry":
+            return OpenTelemetryBackend()
+    except ImportError as e:
+        logging.warning(f"tracing backend {name} isn't available: {e}")
+        return None
+    logging.warning(f"unknown tracing backend {name}")
+    return None
+
+
+backend = make_backend(config.get("tracing_backend"))
+sample_rates = config.get("tracing_sample_rates", dict())
+
+
+def sample_rate(name):
+    if name in sample_rates:
+        return sample_rates[name]
+    prefix = name.split(".")[0]
+    if prefix in sample_rates:
+        return sample_rates[prefix]
+    return sample_rates.get("default", 1.0)
+
+
+def current_span():
+    return getattr(local, "span", None)
+
+
+def span(name, **attrs):
+    """
+    a context manager for a span called name, e.g.
+
+        with tracing.span("ena_runner.scan", sample_method=name) as s:
+            ...
+            s.set("samples", n)
+    """
+    if backend is None:
+        return noop_span
+    parent = current_span()
+    if parent is None and random.random() >= sample_rate(name):
+        return noop_span
+    return Span(backend, name, attrs, parent)
+
+
+def traced(name=None, **attrs):
+    """
+    decorator: run the function in a span (called <module>.<function> by default)
+    """
+
+    def decorator(f):
+        span_name = name or f"{f.__module__}.{f.__name__}"
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if backend is None:
+                return f(*args, **kwargs)
+            with span(span_name, **attrs):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(f):
+    """
+    wrap f so that, when it's run in another thread (e.g. by an executor), its spans
+    are children of the span that is current now
+    """
+    parent = current_span()
+    if backend is None or parent is None:
+        return f
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        previous = current_span()
+        local.span = parent
+        try:
+            return f(*args, **kwargs)
+        finally:
+            local.span = previous
+
+    return wrapper
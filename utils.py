@@ -3,6 +3,10 @@ import logging
 import requests
 import gzip
 import csv 
+import os
+import sqlite3
+import threading
+import time
 from pathlib import Path
 
 def load_config(config_file):
@@ -29,15 +33,94 @@ def get_ena_metadata(sample):
         logging.error(f"empty response from host: {url}")
         return None
 
+# sqlite index of batch0-validated.csv.gz by sample_name, one per csv file
+ena_metadata_index_dir = Path("ena_metadata_index")
+# how often (in seconds) to check whether the csv file has changed
+ena_metadata_check_interval = 60
+ena_metadata_indexes = dict()
+ena_metadata_lock = threading.Lock()
+
+
+def build_ena_metadata_index(csv_file, index_file, signature):
+    """
+    read the csv file once and write its rows to a sqlite table keyed by sample_name
+    """
+    logging.info(f"building ena metadata index {index_file} for {csv_file}")
+    tmp_file = index_file.with_suffix(".tmp")
+    if tmp_file.exists():
+        tmp_file.unlink()
+    con = sqlite3.connect(str(tmp_file))
+    con.execute("create table meta (signature text)")
+    con.execute("create table samples (sample_name text primary key, record text)")
+    with gzip.open(csv_file, mode="rt") as f:
+        reader = csv.DictReader(f)
+        rows = ((record["sample_name"], json.dumps(record)) for record in reader)
+        # keep the first record for a sample, as the linear scan did
+        con.executemany("insert or ignore into samples values (?, ?)", rows)
+    con.execute("insert into meta values (?)", (signature,))
+    con.commit()
+    con.close()
+    os.replace(tmp_file, index_file)
+
+
+def get_ena_metadata_index(watch_dir):
+    """
+    get a sqlite connection to the index of watch_dir's batch0-validated.csv.gz,
+    (re)building it when the csv file's size or mtime has changed
+    """
+    csv_file = Path(watch_dir) / "batch0-validated.csv.gz"
+    with ena_metadata_lock:
+        index = ena_metadata_indexes.get(str(csv_file))
+        if index and time.time() - index["checked"] < ena_metadata_check_interval:
+            return index["con"]
+
+        st = csv_file.stat()
+        signature = f"{st.st_size}:{st.st_mtime}"
+        if index and index["signature"] == signature:
+            index["checked"] = time.time()
+            return index["con"]
+
+        ena_metadata_index_dir.mkdir(exist_ok=True)
+        index_file = ena_metadata_index_dir / (
+            str(csv_file).strip("/").replace("/", "_") + ".sqlite"
+        )
+        if index:
+            index["con"].close()
+        con = None
+        if index_file.exists():
+            con = sqlite3.connect(str(index_file), check_same_thread=False)
+            try:
+                stored = con.execute("select signature from meta").fetchone()
+            except sqlite3.DatabaseError as e:
+                # corrupt, or left over from an interrupted build
+                logging.warning(f"rebuilding unreadable ena metadata index {index_file}: {e}")
+                stored = None
+            if stored != (signature,):
+                con.close()
+                con = None
+        if not con:
+            build_ena_metadata_index(csv_file, index_file, signature)
+            con = sqlite3.connect(str(index_file), check_same_thread=False)
+
+        ena_metadata_indexes[str(csv_file)] = {
+            "con": con,
+            "signature": signature,
+            "checked": time.time(),
+        }
+        return con
+
+
 def get_ena_metadata_from_csv(sample_name, watch_dir):
     logging.info(f"getting ena metadata for {sample_name}")
-    with gzip.open(Path(watch_dir) / "batch0-validated.csv.gz", mode="rt") as f:
-        reader = csv.DictReader(f)
-        ena_rec = [record for record in reader if record["sample_name"] == sample_name]
-        if ena_rec:
-            return ena_rec[0]
-        else:
-            return None
+    con = get_ena_metadata_index(watch_dir)
+    with ena_metadata_lock:
+        row = con.execute(
+            "select record from samples where sample_name = ?", (sample_name,)
+        ).fetchone()
+    if row:
+        return json.loads(row[0])
+    else:
+        return None
 
 def is_number(string):
     
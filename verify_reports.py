@@ -2,10 +2,17 @@
 # python3 verify_reports.py go sp3testdata_v1.json
 #
 
-import json, pathlib, os
+import json, pathlib, os, sys, csv
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import argh
 
+import report_csv
+
+compared_fields = ["species", "lineages", "prediction_ex", "effects"]
+
+
 def get_val_from_dict(dict1, path1):
     try:
         for p in path1.split("."):
@@ -15,70 +22,172 @@ def get_val_from_dict(dict1, path1):
         return None
     return val1
 
-def compare2(sample_name, sp3_report, truth_data):
-    errors = list()
-    species1 = list(get_val_from_dict(sp3_report, "mykrobe_speciation.data.species").keys())
+def effect_key(effect):
+    """
+    hashable canonical form of an effect, so effect lists can be compared as sets
+    """
+    return json.dumps(effect, sort_keys=True)
+
+def mismatch(sample_name, field, message, key=None, sp3=None, truth=None):
+    return {
+        "sample": sample_name,
+        "field": field,
+        "key": key,
+        "sp3": sp3,
+        "truth": truth,
+        "message": f"{sample_name}: {message}",
+    }
+
+def compare_sample(sample_name, sp3_report, truth_data):
+    """
+    compare an sp3 report with its truth data, returning a list of mismatch records
+
+    the sp3 report's effects are compared without their "source". Neither input is changed
+    """
+    mismatches = list()
+    species1 = list((get_val_from_dict(sp3_report, "mykrobe_speciation.data.species") or dict()).keys())
     species2 = [get_val_from_dict(truth_data, "mykrobe_speciation.data.species")]
     if species1 != species2:
-        errors.append(f"{sample_name}: species: {species1} != {species2}")
+        mismatches.append(mismatch(sample_name, "species", f"species: {species1} != {species2}", sp3=species1, truth=species2))
 
     lineages1 = get_val_from_dict(sp3_report, "mykrobe_speciation.data.lineages")
     lineages2 = get_val_from_dict(truth_data, "mykrobe_speciation.data.lineages")
     if lineages1 != lineages2:
-        errors.append(f"{sample_name}: lineages: {lineages1} != {lineages2}")
+        mismatches.append(mismatch(sample_name, "lineages", f"lineages: {lineages1} != {lineages2}", sp3=lineages1, truth=lineages2))
 
-    prediction_ex1 = get_val_from_dict(sp3_report, "resistance.data.prediction_ex")
-    prediction_ex2 = get_val_from_dict(truth_data, "resistance.data.prediction_ex")
+    prediction_ex1 = get_val_from_dict(sp3_report, "resistance.data.prediction_ex") or dict()
+    prediction_ex2 = get_val_from_dict(truth_data, "resistance.data.prediction_ex") or dict()
     for p in set(prediction_ex1.keys()).union(set(prediction_ex2.keys())):
         if p not in prediction_ex1:
-            errors.append(f"{sample_name}: {p} not in sp3 report prediction_ex")
+            mismatches.append(mismatch(sample_name, "prediction_ex", f"{p} not in sp3 report prediction_ex", key=p, truth=prediction_ex2[p]))
             continue
         if p not in prediction_ex2:
-            errors.append(f"{sample_name}: {p} not in truth data prediction_ex")
+            mismatches.append(mismatch(sample_name, "prediction_ex", f"{p} not in truth data prediction_ex", key=p, sp3=prediction_ex1[p]))
             continue
         if prediction_ex1[p] != prediction_ex2[p]:
-            errors.append(f"{sample_name}: prediction_ex key {p}: {prediction_ex1[p]} != {prediction_ex2[p]}")
-
-    effects1 = get_val_from_dict(sp3_report, "resistance.data.effects")
-    effects2 = get_val_from_dict(truth_data, "resistance.data.effects")
+            mismatches.append(mismatch(sample_name, "prediction_ex", f"prediction_ex key {p}: {prediction_ex1[p]} != {prediction_ex2[p]}", key=p, sp3=prediction_ex1[p], truth=prediction_ex2[p]))
+
+    effects1 = [
+        {k: v for k, v in effect.items() if k != "source"}
+        for effect in get_val_from_dict(sp3_report, "resistance.data.effects") or list()
+    ]
+    effects2 = get_val_from_dict(truth_data, "resistance.data.effects") or list()
+    keys1 = set(effect_key(effect) for effect in effects1)
+    keys2 = set(effect_key(effect) for effect in effects2)
     for effect1 in effects1:
-        del effect1['source']
-        if effect1 not in effects2:
-            errors.append(f"{sample_name}: missing effect in truth data: {effect1}")
+        if effect_key(effect1) not in keys2:
+            mismatches.append(mismatch(sample_name, "effects", f"missing effect in truth data: {effect1}", sp3=effect1))
     for effect2 in effects2:
-        if effect2 not in effects1:
-            errors.append(f"{sample_name}: missing effect in sp3 report: {effect2}")
-
-    return errors
-
-def go(reports_file):
-    sp3_reports = json.loads(open(reports_file).read())
-    truth_files = list(pathlib.Path(pathlib.Path(reports_file).stem).glob("*.json"))
-    truth_files = [x.stem for x in truth_files]
+        if effect_key(effect2) not in keys1:
+            mismatches.append(mismatch(sample_name, "effects", f"missing effect in sp3 report: {effect2}", truth=effect2))
 
-    for sample in sp3_reports.keys():
-        if sample not in truth_files:
-            print(f"{sample} missing in truth files")
+    return mismatches
 
-    for sample in truth_files:
-        if sample not in sp3_reports.keys():
-            print(f"{sample} missing in sp3 reports")
-
-    truth_data = dict()
-    for sample_name in sp3_reports.keys():
-        if sample_name not in truth_files:
-            continue
-        truth_file = pathlib.Path(reports_file).stem / pathlib.Path(sample_name + ".json")
-        truth_data[sample_name] = json.loads(open(truth_file).read())
-
-    errors = dict()
-    for sample_name in set(sp3_reports.keys()).intersection(set(truth_files)):
-        errors[sample_name] = compare2(sample_name, sp3_reports[sample_name], truth_data[sample_name])
-
-    for sample_name, errors_ in errors.items():
-        print("")
-        for error in errors_:
-            print(error)
+def compare2(sample_name, sp3_report, truth_data):
+    return [m["message"] for m in compare_sample(sample_name, sp3_report, truth_data)]
+
+def verify_sample(sample_name, sp3_report, truth_file):
+    """
+    load a sample's truth file and compare it with its sp3 report (runs in a worker process)
+    """
+    with open(truth_file) as f:
+        truth_data = json.load(f)
+    return sample_name, compare_sample(sample_name, sp3_report, truth_data)
+
+def verify_all(reports_file, truth_dir, truth_files, workers=None):
+    """
+    compare every sp3 report that has a truth file, across a process pool
+
+    reports are read from reports_file one at a time and only a few per worker are
+    queued at once. Returns the sp3 sample names and { sample_name: mismatches }
+    """
+    sp3_samples = list()
+    results = dict()
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        max_queued = 4 * workers
+        futures = set()
+        for sample_name, sp3_report in report_csv.iter_reports(reports_file):
+            sp3_samples.append(sample_name)
+            if sample_name not in truth_files:
+                continue
+            if len(futures) >= max_queued:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                results.update(future.result() for future in done)
+            truth_file = truth_dir / pathlib.Path(sample_name + ".json")
+            futures.add(executor.submit(verify_sample, sample_name, sp3_report, truth_file))
+        results.update(future.result() for future in futures)
+    return sp3_samples, results
+
+def write_json(out, sp3_samples, truth_files, results):
+    counts = Counter(m["field"] for mismatches in results.values() for m in mismatches)
+    sp3_set = set(sp3_samples)
+    truth_set = set(truth_files)
+    json.dump(
+        {
+            "summary": {
+                "samples_compared": len(results),
+                "samples_with_mismatches": sum(1 for m in results.values() if m),
+                "mismatch_counts": {field: counts[field] for field in compared_fields},
+                "missing_in_truth": [s for s in sp3_samples if s not in truth_set],
+                "missing_in_sp3": [s for s in truth_files if s not in sp3_set],
+            },
+            "mismatches": {
+                sample_name: [{k: v for k, v in m.items() if k != "message"} for m in mismatches]
+                for sample_name, mismatches in sorted(results.items())
+            },
+        },
+        out,
+        indent=4,
+    )
+    out.write("\n")
+
+def write_csv(out, results):
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(["sample"] + compared_fields + ["total"])
+    for sample_name, mismatches in sorted(results.items()):
+        counts = Counter(m["field"] for m in mismatches)
+        writer.writerow([sample_name] + [counts[field] for field in compared_fields] + [len(mismatches)])
+
+def go(reports_file, output_format="text", output=None, workers=None):
+    """
+    compare the reports in reports_file with the truth files in the directory named
+    after it (<reports file stem>/<sample name>.json)
+
+    output_format is text (the mismatch messages), json (per-field mismatch counts,
+    missing samples and every mismatch) or csv (mismatch counts per sample and field)
+    """
+    truth_dir = pathlib.Path(pathlib.Path(reports_file).stem)
+    truth_files = [x.stem for x in truth_dir.glob("*.json")]
+    truth_set = set(truth_files)
+
+    sp3_samples, results = verify_all(
+        reports_file, truth_dir, truth_set, int(workers) if workers else None
+    )
+
+    out = open(output, "w", newline="") if output else sys.stdout
+    try:
+        if output_format == "json":
+            write_json(out, sp3_samples, truth_files, results)
+        elif output_format == "csv":
+            write_csv(out, results)
+        else:
+            sp3_set = set(sp3_samples)
+            for sample in sp3_samples:
+                if sample not in truth_set:
+                    out.write(f"{sample} missing in truth files\n")
+
+            for sample in truth_files:
+                if sample not in sp3_set:
+                    out.write(f"{sample} missing in sp3 reports\n")
+
+            for sample_name, mismatches in results.items():
+                out.write("\n")
+                for m in mismatches:
+                    out.write(m["message"] + "\n")
+    finally:
+        if output:
+            out.close()
 
 
 if __name__ == "__main__":